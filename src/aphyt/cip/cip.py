@@ -6,7 +6,17 @@ __email__ = "jr@aphyt.com"
 from abc import ABC, abstractmethod
 import aphyt.cip as ap
 import binascii
+import functools
 import re
+import struct
+from typing import List, Union
+
+# Precompiled layouts for the fixed size headers of CIP requests and replies
+_CIP_REQUEST_HEADER = struct.Struct('<BB')
+_CIP_REPLY_HEADER = struct.Struct('<BBBB')
+_EXTENDED_SYMBOL_SEGMENT_HEADER = struct.Struct('<BB')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
 
 
 def cip_crc16(data: bytes, poly=0xa001) -> bytes:
@@ -36,15 +46,17 @@ class CIPRequest:
     """
 
     def __init__(self,
-                 request_service: bytes,
+                 request_service: Union[int, bytes],
                  request_path: bytes,
                  request_data: bytes = b''):
         """ Constructor method
 
-        :param request_service: bytes
+        :param request_service: service code as an int or a single byte, it is stored as an int
         :param request_path: bytes
         :param request_data: bytes
         """
+        if not isinstance(request_service, int):
+            request_service = request_service[0]
         self.request_service = request_service
         self.request_data = request_data
         # Length is in Words, so the byte length is divided in half
@@ -53,29 +65,62 @@ class CIPRequest:
 
     @property
     def bytes(self) -> bytes:
-        return \
-            self.request_service + self.request_path_size.to_bytes(1, 'little') + \
-            self.request_path + self.request_data
+        return b''.join((_CIP_REQUEST_HEADER.pack(self.request_service, self.request_path_size),
+                         self.request_path, self.request_data))
 
 
 class CIPReply:
     """
-    Class for parsing CIP replies
+    Class for parsing CIP replies. The reply service, reserved, general status and extended status size
+    header fields are stored as ints, so a successful reply can be checked with ``not reply.general_status``
     """
 
-    def __init__(self, reply_bytes: bytes):
+    def __init__(self, reply_bytes: Union[bytes, bytearray, memoryview]):
         """
 
         :param reply_bytes:
         """
-        self.reply_service = reply_bytes[0:1]
-        self.reserved = reply_bytes[1:2]
-        self.general_status = reply_bytes[2:3]
-        self.extended_status_size = reply_bytes[3:4]
+        reply_view = memoryview(reply_bytes)
+        if not reply_view.readonly:
+            # A writable buffer may be reused by its owner, so it is the one case the reply is copied
+            reply_view = memoryview(bytes(reply_view))
+        self.reply_view = reply_view
+        if len(reply_view) < _CIP_REPLY_HEADER.size:
+            # No CIP reply came back, for example with an encapsulation error. The header fields are zero and the
+            # extended status and reply data are empty
+            self.reply_service = self.reserved = self.general_status = self.extended_status_size = 0
+            self.extended_status = b''
+            self.reply_data_view = reply_view[len(reply_view):]
+            self._reply_data = None
+            return
+        self.reply_service, self.reserved, self.general_status, self.extended_status_size = \
+            _CIP_REPLY_HEADER.unpack_from(reply_view)
         # Research replies that use this. It's usually zero, so I am guessing it is in words (like the request)
-        extended_status_byte_size = int.from_bytes(self.extended_status_size, 'little') * 2
-        self.extended_status = reply_bytes[4:4 + extended_status_byte_size]
-        self.reply_data = reply_bytes[4 + extended_status_byte_size:]
+        extended_status_end = _CIP_REPLY_HEADER.size + self.extended_status_size * 2
+        self.extended_status = bytes(reply_view[_CIP_REPLY_HEADER.size:extended_status_end])
+        self.reply_data_view = reply_view[extended_status_end:]
+        self._reply_data = None
+
+    @classmethod
+    def from_reply(cls, reply: 'CIPReply'):
+        """
+        Read a reply as a more specific reply class. The new reply shares the read only buffer of the original
+        instead of being built from a copy of its bytes
+        :param reply:
+        :return:
+        """
+        return cls(reply.reply_view)
+
+    @property
+    def reply_data(self) -> bytes:
+        """
+        The reply data as bytes. It is copied out of the reply on first use, parsers that only unpack fields
+        should read reply_data_view instead
+        :return:
+        """
+        if self._reply_data is None:
+            self._reply_data = bytes(self.reply_data_view)
+        return self._reply_data
 
     @property
     def bytes(self) -> bytes:
@@ -83,9 +128,38 @@ class CIPReply:
         The bytes in the CIP reply
         :return:
         """
+        if len(self.reply_view) < _CIP_REPLY_HEADER.size:
+            return bytes(self.reply_view)
         return \
-            self.reply_service + self.reserved + self.general_status + \
-            self.extended_status_size + self.extended_status + self.reply_data
+            _CIP_REPLY_HEADER.pack(self.reply_service, self.reserved, self.general_status,
+                                   self.extended_status_size) + \
+            self.extended_status + self.reply_data_view
+
+
+class MultipleServicePacketReply(CIPReply):
+    """
+    CIP Reply from the Multiple Service Packet service, the reply data holds the number of embedded replies,
+    a table of their offsets and then the embedded replies themselves
+    """
+
+    def __init__(self, reply_bytes: Union[bytes, bytearray, memoryview]):
+        super().__init__(reply_bytes=reply_bytes)
+
+    @property
+    def replies(self) -> List[CIPReply]:
+        """
+        The embedded replies in the same order as the requests, empty if the reply did not include them
+        :return:
+        """
+        if len(self.reply_data_view) < 2:
+            return []
+        number_of_replies = _U16.unpack_from(self.reply_data_view, 0)[0]
+        if len(self.reply_data_view) < 2 + 2 * number_of_replies:
+            return []
+        offsets = list(struct.unpack_from('<%dH' % number_of_replies, self.reply_data_view, 2))
+        offsets.append(len(self.reply_data_view))
+        return [CIPReply(self.reply_data_view[offsets[index]:offsets[index + 1]])
+                for index in range(number_of_replies)]
 
 
 class CIPCommonFormat:
@@ -136,29 +210,38 @@ class CIPDispatcher(ABC):
     def execute_cip_command(self, request: CIPRequest) -> CIPReply:
         pass
 
+    def execute_cip_commands(self, requests: List[CIPRequest]) -> List[CIPReply]:
+        """
+        Execute several independent CIP requests, replies are in the same order as the requests. Subclasses
+        that can have more than one request in flight override this, by default they are sent one at a time
+        :param requests:
+        :return:
+        """
+        return [self.execute_cip_command(request) for request in requests]
+
     def read_tag_service(self, tag_request_path, number_of_elements=1) -> CIPReply:
         read_tag_request = \
-            CIPRequest(ap.CIPService.READ_TAG_SERVICE, tag_request_path, number_of_elements.to_bytes(2, 'little'))
+            CIPRequest(ap.CIPService.READ_TAG_SERVICE, tag_request_path, _U16.pack(number_of_elements))
         return self.execute_cip_command(read_tag_request)
 
     def write_tag_service(self, tag_request_path, request_service_data: CIPCommonFormat, number_of_elements=1):
-        data = request_service_data.data_type + \
-               int(request_service_data.additional_info_length).to_bytes(1, 'little') + \
-               request_service_data.additional_info + number_of_elements.to_bytes(2, 'little') + \
-               request_service_data.data
+        data = b''.join((request_service_data.data_type,
+                         int(request_service_data.additional_info_length).to_bytes(1, 'little'),
+                         request_service_data.additional_info, _U16.pack(number_of_elements),
+                         request_service_data.data))
         write_tag_request = CIPRequest(ap.CIPService.WRITE_TAG_SERVICE, tag_request_path, data)
         return self.execute_cip_command(write_tag_request)
 
     def read_tag_fragmented_service(self, tag_request_path, offset, number_of_elements):
-        data = tag_request_path + number_of_elements.to_bytes(2, 'little') + offset.to_bytes(4, 'little')
+        data = tag_request_path + _U16.pack(number_of_elements) + _U32.pack(offset)
         read_tag_fragmented_request = \
             CIPRequest(ap.CIPService.READ_TAG_FRAGMENTED_SERVICE, tag_request_path, data)
         return self.execute_cip_command(read_tag_fragmented_request)
 
     def write_tag_fragmented_service(self, tag_request_path, cip_datatype_code, data, offset, number_of_elements=1):
         data = \
-            cip_datatype_code + b'\x00' + number_of_elements.to_bytes(2, 'little') + \
-            offset.to_bytes(4, 'little') + data
+            cip_datatype_code + b'\x00' + _U16.pack(number_of_elements) + \
+            _U32.pack(offset) + data
         write_tag_fragmented_request = CIPRequest(ap.CIPService.WRITE_TAG_FRAGMENTED_SERVICE, tag_request_path, data)
         return self.execute_cip_command(write_tag_fragmented_request)
 
@@ -174,6 +257,33 @@ class CIPDispatcher(ABC):
         set_attribute_single_request = CIPRequest(ap.CIPService.SET_ATTRIBUTE_SINGLE, tag_request_path, data)
         return self.execute_cip_command(set_attribute_single_request)
 
+    def multiple_service_packet_service(self, requests: List[CIPRequest]) -> MultipleServicePacketReply:
+        """
+        Send several CIP requests to the message router in a single message, the caller is responsible for
+        keeping the request and the reply within the size the target accepts
+        :param requests:
+        :return:
+        """
+        multiple_service_request = self.multiple_service_packet_request(requests)
+        return MultipleServicePacketReply.from_reply(self.execute_cip_command(multiple_service_request))
+
+    @staticmethod
+    def multiple_service_packet_request(requests: List[CIPRequest]) -> CIPRequest:
+        """
+        Build the Multiple Service Packet request carrying the requests without sending it
+        :param requests:
+        :return:
+        """
+        request_bytes_list = [request.bytes for request in requests]
+        # Offsets are from the start of the service count
+        offsets = []
+        offset = 2 + 2 * len(request_bytes_list)
+        for request_bytes in request_bytes_list:
+            offsets.append(offset)
+            offset = offset + len(request_bytes)
+        data = struct.pack('<%dH' % (len(offsets) + 1), len(offsets), *offsets) + b''.join(request_bytes_list)
+        return CIPRequest(ap.CIPService.MULTIPLE_SERVICE_PACKET, _MESSAGE_ROUTER_REQUEST_PATH, data)
+
 
 def address_request_path_segment(class_id: bytes = None, instance_id: bytes = None,
                                  attribute_id: bytes = None, element_id: bytes = None) -> bytes:
@@ -188,7 +298,8 @@ def address_request_path_segment(class_id: bytes = None, instance_id: bytes = No
     :return:
     """
     # Logical segment  1756-pm020 16 of 94
-    request_path_bytes = b''
+    # Accumulated in place, += on a bytearray extends it instead of building a new bytes object each time
+    request_path_bytes = bytearray()
     if class_id is not None:
         # 8-bit id uses b'\x20 16-bit uses b'\x21'
         if len(class_id) == 1:
@@ -215,9 +326,14 @@ def address_request_path_segment(class_id: bytes = None, instance_id: bytes = No
             request_path_bytes += b'\x29\x00' + element_id
         elif len(element_id) == 4:
             request_path_bytes += b'\x2a\x00' + element_id
-    return request_path_bytes
+    return bytes(request_path_bytes)
+
+
+# Message router, class 0x02 instance 1, the target of the Multiple Service Packet service
+_MESSAGE_ROUTER_REQUEST_PATH = address_request_path_segment(class_id=b'\x02', instance_id=b'\x01')
 
 
+@functools.lru_cache(maxsize=2048)
 def variable_request_path_segment(variable_name: str) -> bytes:
     """
     This function is to create a request path using the variable name of the data that the programmer will access
@@ -228,18 +344,20 @@ def variable_request_path_segment(variable_name: str) -> bytes:
     # Symbolic segment
     # 1756-pm020_-en-p.pdf 17 of 94
     res = list(filter(None, re.split(r'\[|\]|\.', variable_name)))
-    request_path = b''
+    request_path = bytearray()
     for token in res:
         if token.isnumeric():
             element_id = int(token)
             request_path += address_request_path_segment(element_id=element_id.to_bytes(4, 'little'))
         else:
             request_path += _extended_symbol_segment(token)
-    return request_path
+    return bytes(request_path)
 
 
-def _extended_symbol_segment(name: str):
-    request_path_bytes = b'\x91' + len(name).to_bytes(1, 'little') + name.encode('utf-8')
-    if len(request_path_bytes) % 2 != 0:
+@functools.lru_cache(maxsize=2048)
+def _extended_symbol_segment(name: str) -> bytes:
+    encoded_name = name.encode('utf-8')
+    request_path_bytes = _EXTENDED_SYMBOL_SEGMENT_HEADER.pack(0x91, len(encoded_name)) + encoded_name
+    if len(encoded_name) % 2 != 0:
         request_path_bytes = request_path_bytes + b'\x00'
     return request_path_bytes
@@ -24,6 +24,7 @@ class CIPService:
     GET_ATTRIBUTE_SINGLE = b'\x0e'
     RESET = b'\x05'
     SET_ATTRIBUTE_SINGLE = b'\x10'
+    MULTIPLE_SERVICE_PACKET = b'\x0a'
 
     def __init__(self, cip_dispatcher: CIPDispatcher, **kwargs):
         self.cip_dispatcher = cip_dispatcher
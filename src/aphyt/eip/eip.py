@@ -3,11 +3,30 @@ __license__ = "GPLv2"
 __maintainer__ = "Joseph Ryan"
 __email__ = "jr@aphyt.com"
 
+import collections
 import socket
+import struct
 import time
-from typing import List, Tuple
+from typing import List, Tuple, Union
 from aphyt.cip import *
 
+# Precompiled layouts for the fixed size portion of each message, the variable length payload is appended after it
+_EIP_HEADER = struct.Struct('<2sH4s4s8s4s')
+_DATA_AND_ADDRESS_ITEM_HEADER = struct.Struct('<2sH')
+_COMMAND_SPECIFIC_DATA_HEADER = struct.Struct('<4s2s')
+# Status, sender context and options of a request header, all zero
+_EIP_HEADER_ZERO_TAIL = b'\x00' * 16
+_U16 = struct.Struct('<H')
+# Sequence number carried in the sender context of pipelined requests, the target echoes it in the reply
+_SENDER_CONTEXT = struct.Struct('<Q')
+# Seconds to wait for a reply once connected, so a reply that never comes raises socket.timeout
+_DEFAULT_MESSAGE_TIMEOUT = 5.0
+# Common packet format of an unconnected message up to the length of the CIP request: item count of two, a null
+# address item and the unconnected message item type
+_UNCONNECTED_COMMON_PACKET_FORMAT_PREFIX = b'\x02\x00' + b'\x00\x00\x00\x00' + b'\xb2\x00'
+# Default command specific data header, interface handle and timeout, before the encapsulated packet
+_DEFAULT_COMMAND_SPECIFIC_DATA_HEADER = b'\x00\x00\x00\x00' + b'\x08\x00'
+
 
 class DataAndAddressItem:
     """
@@ -24,16 +43,14 @@ class DataAndAddressItem:
 
     def __init__(self, type_id, data: bytes):
         self.type_id = type_id
-        self.length = len(data).to_bytes(2, 'little')
         self.data = data
 
     def from_bytes(self, bytes_data_address_item: bytes):
         self.type_id = bytes_data_address_item[0:2]
-        self.length = bytes_data_address_item[2:4]
         self.data = bytes_data_address_item[4:]
 
     def bytes(self):
-        return self.type_id + self.length + self.data
+        return _DATA_AND_ADDRESS_ITEM_HEADER.pack(self.type_id, len(self.data)) + self.data
 
 
 class CommonPacketFormat:
@@ -51,25 +68,44 @@ class CommonPacketFormat:
         else:
             self.packets = packets
         self.item_count = len(self.packets)
-        self.packet_bytes = b''
-        for packet in self.packets:
-            self.packet_bytes += packet.bytes()
-
-    def from_bytes(self, bytes_common_packet_format: bytes):
-        self.item_count = int.from_bytes(bytes_common_packet_format[0:2], 'little')
-        self.packet_bytes = bytes_common_packet_format[2:]
-        packet_offset = 0
+        self.packet_bytes = b''.join(packet.bytes() for packet in self.packets)
+
+    def from_bytes(self, bytes_common_packet_format: Union[bytes, bytearray, memoryview]):
+        packet_view = memoryview(bytes_common_packet_format)
+        # An error reply may carry no packet at all, it then keeps the item count of zero and the default items
+        self.item_count = _U16.unpack_from(packet_view)[0] if len(packet_view) >= _U16.size else 0
+        self.packet_bytes = packet_view[2:]
+        # Parsed items replace the existing ones in order, so a reply with fewer items keeps the defaults after them
+        packets = list(self.packets)
         packet_index = 0
-        while packet_offset < len(self.packet_bytes):
-            data_address_item_id = self.packet_bytes[packet_offset: packet_offset + 2]
-            data_address_item_length = int.from_bytes(self.packet_bytes[packet_offset + 2: packet_offset + 4], 'little')
-            data_address_item_data = self.packet_bytes[packet_offset + 4: packet_offset + data_address_item_length + 4]
-            self.packets[packet_index] = DataAndAddressItem(data_address_item_id, data_address_item_data)
-            packet_offset = packet_offset + data_address_item_length + 4
+        packet_offset = 0
+        while packet_offset + _DATA_AND_ADDRESS_ITEM_HEADER.size <= len(self.packet_bytes):
+            data_address_item_id, data_address_item_length = \
+                _DATA_AND_ADDRESS_ITEM_HEADER.unpack_from(self.packet_bytes, packet_offset)
+            packet_offset = packet_offset + _DATA_AND_ADDRESS_ITEM_HEADER.size
+            data_address_item = DataAndAddressItem(
+                data_address_item_id, self.packet_bytes[packet_offset: packet_offset + data_address_item_length])
+            if packet_index < len(packets):
+                packets[packet_index] = data_address_item
+            else:
+                packets.append(data_address_item)
+            packet_offset = packet_offset + data_address_item_length
             packet_index = packet_index + 1
+        self.packets = packets
 
     def bytes(self):
-        return self.item_count.to_bytes(2, 'little') + self.packet_bytes
+        return _U16.pack(self.item_count) + self.packet_bytes
+
+    @staticmethod
+    def encode_unconnected(cip_bytes: bytes) -> bytes:
+        """
+        Encode a CIP request as an unconnected message with a null address item without building the
+        DataAndAddressItem and CommonPacketFormat objects. The bytes are the same as
+        CommonPacketFormat([DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, cip_bytes)]).bytes()
+        :param cip_bytes:
+        :return:
+        """
+        return b''.join((_UNCONNECTED_COMMON_PACKET_FORMAT_PREFIX, _U16.pack(len(cip_bytes)), cip_bytes))
 
 
 class CommandSpecificData:
@@ -90,7 +126,7 @@ class CommandSpecificData:
         self.encapsulated_packet = bytes_command_specific_data[6:]
 
     def bytes(self):
-        return self.interface_handle + self.timeout + self.encapsulated_packet
+        return _COMMAND_SPECIFIC_DATA_HEADER.pack(self.interface_handle, self.timeout) + self.encapsulated_packet
 
 
 class EIPMessage:
@@ -118,26 +154,25 @@ class EIPMessage:
         :param command_options:
         """
         self.command = command
-        self.length = len(command_data).to_bytes(2, 'little')
         self.session_handle_id = session_handle_id
         self.status = status
         self.sender_context_data = sender_context_data
         self.command_options = command_options
         self.command_data = command_data
 
+    def header_bytes(self) -> bytes:
+        return _EIP_HEADER.pack(self.command, len(self.command_data), self.session_handle_id, self.status,
+                                self.sender_context_data, self.command_options)
+
     def bytes(self) -> bytes:
-        return \
-            self.command + self.length + self.session_handle_id + self.status + \
-            self.sender_context_data + self.command_options + self.command_data
+        return self.header_bytes() + self.command_data
 
-    def from_bytes(self, eip_message_bytes: bytes):
-        self.command = eip_message_bytes[0:2]
-        self.length = eip_message_bytes[2:4]
-        self.session_handle_id = eip_message_bytes[4:8]
-        self.status = eip_message_bytes[8:12]
-        self.sender_context_data = eip_message_bytes[12:20]
-        self.command_options = eip_message_bytes[20:24]
-        self.command_data = eip_message_bytes[24:]
+    def from_bytes(self, eip_message_bytes: Union[bytes, bytearray, memoryview]):
+        self.command, length, self.session_handle_id, self.status, self.sender_context_data, \
+            self.command_options = _EIP_HEADER.unpack_from(eip_message_bytes)
+        # Kept as bytes, it is returned by the list services. Its length is not stored, command_data is the only
+        # source for it
+        self.command_data = bytes(eip_message_bytes[_EIP_HEADER.size:_EIP_HEADER.size + length])
 
 
 class EIPDispatcher(ABC):
@@ -183,10 +218,24 @@ class EIPConnectedCommandMixin(EIPDispatcher):
         self.session_handle_id = b'\x00\x00\x00\x00\x00\x00\x00\x00'
         self.is_connected_explicit = False
         self.has_session_handle = False
-        self.BUFFER_SIZE = 4096
+        self._session_header_suffix = None
+        # Sized for the largest message the 16 bit encapsulation length allows, and reused for every reply.
+        # Received bytes from _receive_start to _receive_end have not been handed out as a message yet
+        self.BUFFER_SIZE = _EIP_HEADER.size + 0xffff
+        self._receive_buffer = bytearray(self.BUFFER_SIZE)
+        self._receive_view = memoryview(self._receive_buffer)
+        self._receive_start = 0
+        self._receive_end = 0
         self.host = None
+        # Timeout in seconds for a reply once connected, None blocks until the reply arrives
+        self.message_timeout = _DEFAULT_MESSAGE_TIMEOUT
+        self.RECEIVE_BUFFER_SIZE = 262144
+        self.SEND_BUFFER_SIZE = 65536
+
+    def __enter__(self):
+        return self
 
-    def __del__(self):
+    def __exit__(self, exc_type, exc_val, exc_tb):
         self.close_explicit()
 
     def send_command(self, eip_command: EIPMessage, host) -> EIPMessage:
@@ -198,24 +247,96 @@ class EIPConnectedCommandMixin(EIPDispatcher):
         """
         received_eip_message = EIPMessage()
         if self.is_connected_explicit:
-            self.explicit_message_socket.send(eip_command.bytes())
-            received_data = self.explicit_message_socket.recv(self.BUFFER_SIZE)
-            received_eip_message.from_bytes(received_data)
+            self._send_message(eip_command)
+            received_eip_message = self._receive_message()
+        return received_eip_message
+
+    def _send_session_command(self, command: bytes, command_data: bytes) -> EIPMessage:
+        """
+        Fast path of send_command for a registered session. The session handle and the zeroed status, sender
+        context and options are prepared once by register_session, so only the command and length are added
+        :param command:
+        :param command_data:
+        :return:
+        """
+        header_bytes = b''.join((command, _U16.pack(len(command_data)), self._session_header_suffix))
+        self._send_buffers(header_bytes, command_data)
+        return self._receive_message()
+
+    def _send_message(self, eip_command: EIPMessage):
+        self._send_buffers(eip_command.header_bytes(), eip_command.command_data)
+
+    def _send_buffers(self, header_bytes: bytes, command_data: bytes):
+        """
+        Send the whole message, handing the header and command data to the socket separately where sendmsg
+        is available so they are not joined first
+        :param header_bytes:
+        :param command_data:
+        """
+        if hasattr(self.explicit_message_socket, 'sendmsg'):
+            sent_size = self.explicit_message_socket.sendmsg([header_bytes, command_data])
+            if sent_size < len(header_bytes) + len(command_data):
+                self.explicit_message_socket.sendall((header_bytes + command_data)[sent_size:])
+        else:
+            self.explicit_message_socket.sendall(header_bytes + command_data)
+
+    def _receive_message(self) -> EIPMessage:
+        """
+        Receive one complete Ethernet/IP message using the length in its encapsulation header. Whatever the
+        socket has ready is read, so replies to pipelined requests that arrive together cost a single recv
+        :return:
+        """
+        received_eip_message = EIPMessage()
+        self._receive_into(_EIP_HEADER.size)
+        length = _EIP_HEADER.unpack_from(self._receive_view, self._receive_start)[1]
+        self._receive_into(_EIP_HEADER.size + length)
+        message_start = self._receive_start
+        message_end = message_start + _EIP_HEADER.size + length
+        # from_bytes copies the message out of the view, the receive buffer is overwritten by the next reply
+        received_eip_message.from_bytes(self._receive_view[message_start:message_end])
+        if message_end == self._receive_end:
+            self._receive_start = self._receive_end = 0
+        else:
+            self._receive_start = message_end
         return received_eip_message
 
+    def _receive_into(self, size: int):
+        """
+        Receive until at least size bytes are buffered, a reply is not guaranteed to arrive in a single TCP
+        segment
+        :param size:
+        """
+        buffered_size = self._receive_end - self._receive_start
+        if self._receive_start + size > self.BUFFER_SIZE:
+            # Move the partial message to the front so the rest of it fits
+            self._receive_view[:buffered_size] = self._receive_view[self._receive_start:self._receive_end]
+            self._receive_start = 0
+            self._receive_end = buffered_size
+        while self._receive_end - self._receive_start < size:
+            received_size = self.explicit_message_socket.recv_into(self._receive_view[self._receive_end:])
+            if received_size == 0:
+                raise ConnectionError('Connection closed before a complete Ethernet/IP reply was received')
+            self._receive_end = self._receive_end + received_size
+
     def connect_explicit(self, host, connection_timeout: float = None):
         """
-        Create and explicit Ethernet/IP connection
+        Create and explicit Ethernet/IP connection. The message_timeout attribute is applied to the socket
+        once it is connected
         :param connection_timeout:
         :param host:
         """
         try:
             self.explicit_message_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            old_timeout = self.explicit_message_socket.gettimeout()
+            # Requests are small and pipelined requests have to go out as they are sent, so do not let Nagle
+            # hold them back
+            self.explicit_message_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.explicit_message_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_SIZE)
+            self.explicit_message_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER_SIZE)
             if connection_timeout is not None:
                 self.explicit_message_socket.settimeout(connection_timeout)
             self.explicit_message_socket.connect((host, self.explicit_message_port))
-            self.explicit_message_socket.settimeout(old_timeout)
+            self.explicit_message_socket.settimeout(self.message_timeout)
+            self._receive_start = self._receive_end = 0
             self.host = host
             self.is_connected_explicit = True
         except socket.error as err:
@@ -231,6 +352,8 @@ class EIPConnectedCommandMixin(EIPDispatcher):
         """
         self.is_connected_explicit = False
         self.has_session_handle = False
+        self._session_header_suffix = None
+        self._receive_start = self._receive_end = 0
         self.host = None
         if self.explicit_message_socket:
             self.explicit_message_socket.close()
@@ -245,6 +368,7 @@ class EIPConnectedCommandMixin(EIPDispatcher):
         response = self.send_command(eip_message, self.host)
         self.has_session_handle = True
         self.session_handle_id = response.session_handle_id
+        self._session_header_suffix = self.session_handle_id + _EIP_HEADER_ZERO_TAIL
         return response
 
 
@@ -291,6 +415,9 @@ class EIPConnectedCIPDispatcher(EIPConnectedCommandMixin, CIPDispatcher):
 
     def __init__(self):
         super().__init__()
+        # Requests execute_cip_commands keeps in flight before waiting on the oldest reply
+        self.PIPELINE_WINDOW = 16
+        self._sender_context_sequence = 0
 
     def execute_cip_command(self, request: CIPRequest) -> CIPReply:
         """
@@ -298,39 +425,96 @@ class EIPConnectedCIPDispatcher(EIPConnectedCommandMixin, CIPDispatcher):
         :param request:
         :return:
         """
-        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, request.bytes)
-        packets = [data_address_item]
         # ToDo add interface handle to track responses?
-        common_packet_format = CommonPacketFormat(packets)
-        command_specific_data = CommandSpecificData(encapsulated_packet=common_packet_format.bytes())
-        response = self.send_rr_data(command_specific_data.bytes()).packets[1].bytes()
-        reply_data_and_address_item = DataAndAddressItem('', b'')
+        reply_data_and_address_item = self.send_rr_data(self._unconnected_command_specific_data(request)).packets[1]
         # ToDo is this removing error data?
-        reply_data_and_address_item.from_bytes(response)
         cip_reply = CIPReply(reply_data_and_address_item.data)
         return cip_reply
 
-    # @staticmethod
-    # def command_specific_data_from_eip_message_bytes(eip_message_bytes: bytes):
-    #     """
-    #     Extracts command specific data from Ethernet/IP reply bytes
-    #     :param eip_message_bytes:
-    #     :return:
-    #     """
-    #     eip_message = EIPMessage()
-    #     eip_message.from_bytes(eip_message_bytes)
-    #     return EIPConnectedCIPDispatcher.command_specific_data_from_eip_message(eip_message)
-    #
-    # @staticmethod
-    # def command_specific_data_from_eip_message(eip_message: EIPMessage) -> CommandSpecificData:
-    #     """
-    #     Extracts the command specific data from an Ethernet/IP message
-    #     :param eip_message:
-    #     :return:
-    #     """
-    #     command_specific_data = CommandSpecificData()
-    #     command_specific_data.from_bytes(eip_message.bytes())
-    #     return command_specific_data
+    def execute_cip_commands(self, requests: List[CIPRequest]) -> List[CIPReply]:
+        """
+        Keeps up to PIPELINE_WINDOW requests in flight on the connection instead of waiting for each reply
+        before sending the next request. If anything fails with requests still in flight the connection is
+        closed, as their replies would otherwise be read as the replies to later requests
+        :param requests:
+        :return:
+        """
+        if not self.is_connected_explicit:
+            return super().execute_cip_commands(requests)
+        replies = []
+        in_flight = collections.deque()
+        try:
+            for request in requests:
+                if len(in_flight) >= self.PIPELINE_WINDOW:
+                    replies.append(self.recv_cip_reply(in_flight.popleft()))
+                in_flight.append(self.send_cip_command(request))
+            while in_flight:
+                replies.append(self.recv_cip_reply(in_flight.popleft()))
+        except BaseException:
+            self.close_explicit()
+            raise
+        return replies
+
+    def send_cip_command(self, request: CIPRequest) -> int:
+        """
+        Send a CIP request without waiting for its reply
+        :param request:
+        :return: sequence number to pass to recv_cip_reply
+        """
+        self._sender_context_sequence = (self._sender_context_sequence + 1) & 0xffffffffffffffff
+        eip_message = EIPMessage(b'\x6f\x00', self._unconnected_command_specific_data(request),
+                                 self.session_handle_id,
+                                 sender_context_data=_SENDER_CONTEXT.pack(self._sender_context_sequence))
+        self._send_message(eip_message)
+        return self._sender_context_sequence
+
+    def recv_cip_reply(self, sequence_number: int) -> CIPReply:
+        """
+        Receive the reply to the request send_cip_command returned the sequence number for. The target answers
+        requests in the order they were sent, so replies have to be received in that order too. A reply with a
+        different sender context means the connection is out of step, so it is closed and ConnectionError is
+        raised
+        :param sequence_number:
+        :return:
+        """
+        reply = self._receive_message()
+        if reply.sender_context_data != _SENDER_CONTEXT.pack(sequence_number):
+            self.close_explicit()
+            raise ConnectionError('Ethernet/IP reply sender context does not match the request')
+        return CIPReply(self._common_packet_format_from_eip_message(reply).packets[1].data)
+
+    @staticmethod
+    def _unconnected_command_specific_data(request: CIPRequest) -> bytes:
+        """
+        Same bytes as CommandSpecificData(encapsulated_packet=CommonPacketFormat.encode_unconnected(...)).bytes()
+        :param request:
+        :return:
+        """
+        return _DEFAULT_COMMAND_SPECIFIC_DATA_HEADER + CommonPacketFormat.encode_unconnected(request.bytes)
+
+    @staticmethod
+    def command_specific_data_from_eip_message_bytes(eip_message_bytes: bytes):
+        """
+        Extracts command specific data from Ethernet/IP reply bytes
+        :param eip_message_bytes:
+        :return:
+        """
+        eip_message = EIPMessage()
+        eip_message.from_bytes(eip_message_bytes)
+        return EIPConnectedCIPDispatcher.command_specific_data_from_eip_message(eip_message)
+
+    @staticmethod
+    def command_specific_data_from_eip_message(eip_message: EIPMessage) -> CommandSpecificData:
+        """
+        Extracts the command specific data from an Ethernet/IP message. It is built directly from the
+        already parsed command data instead of serializing the message again
+        :param eip_message:
+        :return:
+        """
+        command_data = eip_message.command_data
+        return CommandSpecificData(interface_handle=command_data[0:4],
+                                   timeout=command_data[4:6],
+                                   encapsulated_packet=command_data[6:])
 
     def send_rr_data(self, command_specific_data: bytes) -> CommonPacketFormat:
         """
@@ -338,10 +522,15 @@ class EIPConnectedCIPDispatcher(EIPConnectedCommandMixin, CIPDispatcher):
         :param command_specific_data:
         :return:
         """
-        eip_message = EIPMessage(b'\x6f\x00', command_specific_data, self.session_handle_id)
-        reply = self.send_command(eip_message, self.host)
-        reply_command_specific_data = CommandSpecificData()
-        reply_command_specific_data.from_bytes(reply.command_data)
+        if self.is_connected_explicit and self._session_header_suffix is not None:
+            reply = self._send_session_command(b'\x6f\x00', command_specific_data)
+        else:
+            eip_message = EIPMessage(b'\x6f\x00', command_specific_data, self.session_handle_id)
+            reply = self.send_command(eip_message, self.host)
+        return self._common_packet_format_from_eip_message(reply)
+
+    def _common_packet_format_from_eip_message(self, eip_message: EIPMessage) -> CommonPacketFormat:
+        reply_command_specific_data = self.command_specific_data_from_eip_message(eip_message)
         reply_packet = CommonPacketFormat([])
         reply_packet.from_bytes(reply_command_specific_data.encapsulated_packet)
         return reply_packet
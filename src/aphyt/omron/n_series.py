@@ -5,16 +5,85 @@ __email__ = "jr@aphyt.com"
 
 import binascii
 import concurrent.futures
+import functools
 import pickle
 import socket
 import struct
 import sys
 import threading
 from signal import signal, SIGINT
+from typing import List
 
 from aphyt.eip import *
 import logging
 
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<L")
+# Variable object reply fields before and after the list of array dimension sizes
+_VARIABLE_OBJECT_HEADER = struct.Struct("<L1s1sB")
+_VARIABLE_OBJECT_TAIL = struct.Struct("<B3xL")
+# Simple data segment: type code, length in words, offset and size
+_SIMPLE_DATA_SEGMENT = struct.Struct("<1s1sLH")
+_CIP_STRING_CODE = CIPString.data_type_code()
+_CIP_ARRAY_CODE = CIPArray.data_type_code()
+_CIP_STRUCTURE_CODE = CIPStructure.data_type_code()
+_CIP_ABBREVIATED_STRUCTURE_CODE = CIPAbbreviatedStructure.data_type_code()
+# Request paths of the Omron tag name server, variable object and variable type object classes up to the 16 bit
+# instance id, which is appended for each request
+_TAG_NAME_SERVER_PATH_PREFIX = address_request_path_segment(class_id=b'\x6a', instance_id=b'\x00\x00')[:-2]
+_VARIABLE_OBJECT_PATH_PREFIX = address_request_path_segment(class_id=b'\x6b', instance_id=b'\x00\x00')[:-2]
+_VARIABLE_TYPE_OBJECT_PATH_PREFIX = address_request_path_segment(class_id=b'\x6c', instance_id=b'\x00\x00')[:-2]
+# Expected get attribute all reply data sizes used to size Multiple Service Packet batches. Tag names are assumed
+# to be up to 32 characters and variables not to be arrays, a batch whose reply is still too large is split
+_TAG_NAME_SERVER_REPLY_SIZE = 4 + 1 + 32 + 1
+_VARIABLE_OBJECT_REPLY_SIZE = 24
+# General status of a reply that would not fit in the message
+_REPLY_DATA_TOO_LARGE = 0x11
+
+
+@functools.lru_cache(maxsize=None)
+def _u32_array_struct(count: int) -> struct.Struct:
+    """Struct for count consecutive little endian unsigned 32 bit integers, like the array dimension sizes"""
+    return struct.Struct("<%dL" % count)
+
+
+def _parsed_key(name: str) -> str:
+    """Key under which a reply property named name keeps its parsed value in the reply __dict__"""
+    return '_parsed_' + name.lstrip('_')
+
+
+def _reply_property(method):
+    """
+    Read only property for the reply classes that parses its field once and keeps the result on the reply,
+    the reply data never changes after the reply is created
+    """
+    attribute_name = _parsed_key(method.__name__)
+
+    @functools.wraps(method)
+    def getter(self):
+        try:
+            return self.__dict__[attribute_name]
+        except KeyError:
+            value = self.__dict__[attribute_name] = method(self)
+            return value
+    getter.parsed_key = attribute_name
+    return property(getter)
+
+
+def _set_parsed(reply, **fields):
+    """
+    Fill the cache of the reply properties of reply with already parsed values
+    :param reply: reply whose class defines the properties with _reply_property
+    :param fields: parsed value of each property by property name
+    """
+    reply_class = type(reply)
+    for name, value in fields.items():
+        reply_property = getattr(reply_class, name, None)
+        parsed_key = getattr(getattr(reply_property, 'fget', None), 'parsed_key', None)
+        if parsed_key is None:
+            raise AttributeError("%s has no reply property %s" % (reply_class.__name__, name))
+        reply.__dict__[parsed_key] = value
+
 
 class VariableTypeObjectReply(CIPReply):
     """
@@ -25,87 +94,88 @@ class VariableTypeObjectReply(CIPReply):
     def __init__(self, reply_bytes: bytes):
         super().__init__(reply_bytes=reply_bytes)
 
-    @property
+    @_reply_property
     def size_in_memory(self):
-        return struct.unpack("<L", self.reply_data[0:4])[0]
+        return _U32.unpack_from(self.reply_data_view, 0)[0]
 
     @property
     def size(self):
         return self.size_in_memory
 
-    @property
+    @_reply_property
     def cip_data_type(self):
-        return self.reply_data[5:6]
+        return bytes(self.reply_data_view[5:6])
 
-    @property
+    @_reply_property
     def cip_data_type_of_array(self):
-        return self.reply_data[6:7]
+        return bytes(self.reply_data_view[6:7])
 
-    @property
+    @_reply_property
     def array_dimension(self):
-        return struct.unpack("<B", self.reply_data[7:8])[0]
+        return self.reply_data_view[7]
 
-    @property
+    @_reply_property
     def number_of_elements(self):
         """Number of elements in each dimension of  the array"""
-        dimension_size_list = []
-        for i in range(self.array_dimension):
-            dimension_size = struct.unpack("<L", self.reply_data[8 + i * 4:8 + i * 4 + 4])[0]
-            dimension_size_list.append(dimension_size)
-        return dimension_size_list
+        return list(_u32_array_struct(self.array_dimension).unpack_from(self.reply_data_view, 8))
 
-    @property
+    @_reply_property
+    def _dimension_offset(self):
+        """Offset added to every field after the variable length list of dimension sizes"""
+        return self.array_dimension * 4
+
+    @_reply_property
     def number_of_members(self):
-        return struct.unpack("<H", self.reply_data[8 + self.array_dimension * 4:10 + self.array_dimension * 4])[0]
+        return _U16.unpack_from(self.reply_data_view, 8 + self._dimension_offset)[0]
 
-    @property
+    @_reply_property
     def crc_code(self):
-        return struct.unpack("<H", self.reply_data[14 + self.array_dimension * 4:16 + self.array_dimension * 4])[0]
+        return _U16.unpack_from(self.reply_data_view, 14 + self._dimension_offset)[0]
 
-    @property
+    @_reply_property
     def variable_type_name_length(self):
-        return struct.unpack("<B", self.reply_data[16 + self.array_dimension * 4:17 + self.array_dimension * 4])[0]
+        return self.reply_data_view[16 + self._dimension_offset]
 
-    @property
+    @_reply_property
     def padding(self):
         if self.variable_type_name_length % 2 == 0:
             return 1
         else:
             return 0
 
-    @property
+    @_reply_property
     def variable_type_name(self):
-        return \
-            self.reply_data[17 + self.array_dimension * 4:
-                            17 + self.array_dimension * 4 + self.variable_type_name_length]
+        name_offset = 17 + self._dimension_offset
+        return bytes(self.reply_data_view[name_offset:name_offset + self.variable_type_name_length])
 
-    @property
+    @_reply_property
+    def _name_end_offset(self):
+        """Offset of the first field after the padded variable type name"""
+        return self.padding + 17 + self._dimension_offset + self.variable_type_name_length
+
+    @_reply_property
     def next_instance_id(self):
-        return \
-            self.reply_data[self.padding + 17 + self.array_dimension * 4 + self.variable_type_name_length:
-                            self.padding + 17 + self.array_dimension * 4 + self.variable_type_name_length + 4]
+        return bytes(self.reply_data_view[self._name_end_offset:self._name_end_offset + 4])
 
-    @property
+    @_reply_property
+    def next_instance_id_int(self):
+        return _U32.unpack_from(self.reply_data_view, self._name_end_offset)[0]
+
+    @_reply_property
     def nesting_variable_type_instance_id(self):
-        return \
-            self.reply_data[self.padding + 21 + self.array_dimension * 4 + self.variable_type_name_length:
-                            self.padding + 21 + self.array_dimension * 4 + self.variable_type_name_length + 4]
+        return bytes(self.reply_data_view[self._name_end_offset + 4:self._name_end_offset + 8])
 
-    @property
+    @_reply_property
+    def nesting_variable_type_instance_id_int(self):
+        return _U32.unpack_from(self.reply_data_view, self._name_end_offset + 4)[0]
+
+    @_reply_property
     def start_array_elements(self):
         """Number of elements in each dimension of  the array"""
-        array_start_list = []
-        for i in range(self.array_dimension):
-            array_start = \
-                struct.unpack("<L",
-                              self.reply_data[self.padding + 25 +
-                                              self.array_dimension * 4 +
-                                              self.variable_type_name_length:
-                                              self.padding + 25 +
-                                              self.array_dimension * 4 +
-                                              self.variable_type_name_length + 4])[0]
-            array_start_list.append(array_start)
-        return array_start_list
+        # Every dimension reads the same offset, so it is only unpacked once
+        array_start = _U32.unpack_from(self.reply_data_view, self._name_end_offset + 8)[0] \
+            if self.array_dimension else 0
+        return [array_start] * self.array_dimension
 
 
 class VariableObjectReply(CIPReply):
@@ -117,51 +187,78 @@ class VariableObjectReply(CIPReply):
     def __init__(self, reply_bytes: bytes):
         super().__init__(reply_bytes=reply_bytes)
 
-    @property
+    def parse(self):
+        """
+        Parse every field in a single pass over the reply when most of them are going to be used, the
+        properties then return the parsed values
+        :return: the reply
+        """
+        reply_data_view = self.reply_data_view
+        size, cip_data_type, cip_data_type_of_array, array_dimension = \
+            _VARIABLE_OBJECT_HEADER.unpack_from(reply_data_view, 0)
+        dimension_offset = array_dimension * 4
+        bit_number, variable_type_instance_id = _VARIABLE_OBJECT_TAIL.unpack_from(reply_data_view,
+                                                                                    16 + dimension_offset)
+        array_start = _U32.unpack_from(reply_data_view, 24 + dimension_offset)[0] if array_dimension else 0
+        _set_parsed(
+            self,
+            size=size,
+            cip_data_type=cip_data_type,
+            cip_data_type_of_array=cip_data_type_of_array,
+            array_dimension=array_dimension,
+            number_of_elements=list(_u32_array_struct(array_dimension).unpack_from(reply_data_view, 8)),
+            _dimension_offset=dimension_offset,
+            bit_number=bit_number,
+            variable_type_instance_id_int=variable_type_instance_id,
+            start_array_elements=[array_start] * array_dimension)
+        return self
+
+    @_reply_property
     def size(self):
-        return struct.unpack("<L", self.reply_data[0:4])[0]
+        return _U32.unpack_from(self.reply_data_view, 0)[0]
 
-    @property
+    @_reply_property
     def cip_data_type(self):
-        return self.reply_data[4:5]
+        return bytes(self.reply_data_view[4:5])
 
-    @property
+    @_reply_property
     def cip_data_type_of_array(self):
-        return self.reply_data[5:6]
+        return bytes(self.reply_data_view[5:6])
 
-    @property
+    @_reply_property
     def array_dimension(self):
         # One byte of padding after this. Skip to byte 8
-        return struct.unpack("<B", self.reply_data[6:7])[0]
+        return self.reply_data_view[6]
 
-    @property
+    @_reply_property
     def number_of_elements(self):
         """Number of elements in each dimension of  the array"""
-        dimension_size_list = []
-        for i in range(self.array_dimension):
-            dimension_size = struct.unpack("<L", self.reply_data[8 + i * 4:8 + i * 4 + 4])[0]
-            dimension_size_list.append(dimension_size)
-        return dimension_size_list
+        return list(_u32_array_struct(self.array_dimension).unpack_from(self.reply_data_view, 8))
 
-    @property
+    @_reply_property
+    def _dimension_offset(self):
+        """Offset added to every field after the variable length list of dimension sizes"""
+        return self.array_dimension * 4
+
+    @_reply_property
     def bit_number(self):
-        return struct.unpack("<B", self.reply_data[16 + self.array_dimension * 4:17 + self.array_dimension * 4])[0]
+        return self.reply_data_view[16 + self._dimension_offset]
 
-    @property
+    @_reply_property
     def variable_type_instance_id(self):
-        return self.reply_data[20 + self.array_dimension * 4:24 + self.array_dimension * 4]
+        return bytes(self.reply_data_view[20 + self._dimension_offset:24 + self._dimension_offset])
 
-    @property
+    @_reply_property
+    def variable_type_instance_id_int(self):
+        return _U32.unpack_from(self.reply_data_view, 20 + self._dimension_offset)[0]
+
+    @_reply_property
     def start_array_elements(self):
         """Number of elements in each dimension of  the array"""
-        array_start_list = []
-        for i in range(self.array_dimension):
-            array_start = \
-                struct.unpack("<L",
-                              self.reply_data[24 + self.array_dimension * 4:
-                                              24 + self.array_dimension * 4 + 4])[0]
-            array_start_list.append(array_start)
-        return array_start_list
+        # Every dimension reads the same offset, so it is only unpacked once
+        array_start = _U32.unpack_from(self.reply_data_view, 24 + self._dimension_offset)[0] \
+            if self.array_dimension else 0
+        return [array_start] * self.array_dimension
 
 
 class VariableNameAttributeAllReply(CIPReply):
@@ -175,7 +272,7 @@ class VariableNameAttributeAllReply(CIPReply):
 
     @property
     def cip_data_type(self):
-        return self.reply_data[4:5]
+        return bytes(self.reply_data_view[4:5])
 
     @property
     def instance_id(self):
@@ -183,11 +280,11 @@ class VariableNameAttributeAllReply(CIPReply):
         Instance ID will is where the
         :return:
         """
-        return self.reply_data[8:12]
+        return bytes(self.reply_data_view[8:12])
 
     @property
     def variable_type_id(self):
-        return self.reply_data[12:16]
+        return bytes(self.reply_data_view[12:16])
 
 
 class SimpleDataSegmentRequest:
@@ -203,9 +300,7 @@ class SimpleDataSegmentRequest:
         self.size = size
 
     def bytes(self):
-        return \
-                self.simple_data_type_code + self.segment_length + \
-                struct.pack("<L", self.offset) + struct.pack("<H", self.size)
+        return _SIMPLE_DATA_SEGMENT.pack(self.simple_data_type_code, self.segment_length, self.offset, self.size)
 
 
 class NSeries:
@@ -217,10 +312,15 @@ class NSeries:
     and CIP services common to most Ethernet/IP devices
     """
     MAXIMUM_LENGTH = 502  # UCMM maximum length is 502 bytes
+    # Most get attribute all requests per Multiple Service Packet, fewer are sent when the request or the
+    # expected reply would not fit in a UCMM message
+    MULTIPLE_SERVICE_BATCH_SIZE = 16
 
     def __init__(self, host=None, timeout=None):
         super().__init__()
         self.derived_data_type_dictionary = {}
+        # Variable type object replies by instance id, structures that share a member type only fetch it once
+        self._variable_type_objects = {}
         self.connected_cip_dispatcher = EIPConnectedCIPDispatcher()
         update_data_type_dictionary(self.connected_cip_dispatcher.data_type_dictionary)
         if host is not None:
@@ -234,6 +334,7 @@ class NSeries:
         self.close_explicit()
 
     def connect_explicit(self, host, connection_timeout: float = None):
+        self._variable_type_objects = {}
         self.connected_cip_dispatcher.connect_explicit(host, connection_timeout)
 
     def close_explicit(self):
@@ -252,8 +353,78 @@ class NSeries:
         get_instance_list_request = CIPRequest(b'\x5f', tag_request_path, data)
         return self.connected_cip_dispatcher.execute_cip_command(get_instance_list_request)
 
+    def _multi_get_attribute_all(self, request_paths: List[bytes], expected_reply_size: int) -> List[CIPReply]:
+        """
+        Get attribute all on every request path, packing the requests into Multiple Service Packets so a batch
+        costs one round trip and keeping several batches in flight. A batch is limited by the size of its request
+        and by the expected size of its reply. A batch the controller finds too large to answer is split in
+        half, and any request the controller did not answer in its batch is sent on its own
+        :param request_paths:
+        :param expected_reply_size: expected size of the reply data to each request
+        :return: replies in the same order as the request paths
+        """
+        requests = [CIPRequest(CIPService.GET_ATTRIBUTE_ALL, request_path) for request_path in request_paths]
+        batches = self._multiple_service_batches(request_paths, expected_reply_size)
+        replies = [None] * len(requests)
+        while batches:
+            batch_requests = [requests[batch[0]] if len(batch) == 1 else
+                              CIPDispatcher.multiple_service_packet_request([requests[index] for index in batch])
+                              for batch in batches]
+            batch_replies = self.connected_cip_dispatcher.execute_cip_commands(batch_requests)
+            retry_batches = []
+            for batch, batch_reply in zip(batches, batch_replies):
+                if len(batch) == 1:
+                    replies[batch[0]] = batch_reply
+                elif batch_reply.general_status == _REPLY_DATA_TOO_LARGE:
+                    half = len(batch) // 2
+                    retry_batches.extend((batch[:half], batch[half:]))
+                else:
+                    embedded_replies = MultipleServicePacketReply.from_reply(batch_reply).replies
+                    for position, index in enumerate(batch):
+                        if (position < len(embedded_replies) and embedded_replies[position].reply_service and
+                                embedded_replies[position].general_status == 0):
+                            replies[index] = embedded_replies[position]
+                        else:
+                            retry_batches.append([index])
+            batches = retry_batches
+        return replies
+
+    def _multiple_service_batches(self, request_paths: List[bytes], expected_reply_size: int) -> List[List[int]]:
+        """
+        Group the indexes of the request paths into batches whose Multiple Service Packet request and expected
+        reply both fit in a UCMM message
+        :param request_paths:
+        :param expected_reply_size:
+        :return:
+        """
+        # Offset table entry, service code, path size and the path
+        request_lengths = [4 + len(request_path) for request_path in request_paths]
+        # Offset table entry, reply header and the reply data
+        reply_length = 6 + expected_reply_size
+        batches = []
+        batch = []
+        # Request header, message router path and the number of services
+        batch_length = 8
+        # Reply header and the number of replies
+        batch_reply_length = 6
+        for index, request_length in enumerate(request_lengths):
+            if batch and (len(batch) == self.MULTIPLE_SERVICE_BATCH_SIZE or
+                          batch_length + request_length > self.MAXIMUM_LENGTH or
+                          batch_reply_length + reply_length > self.MAXIMUM_LENGTH):
+                batches.append(batch)
+                batch = []
+                batch_length = 8
+                batch_reply_length = 6
+            batch.append(index)
+            batch_length = batch_length + request_length
+            batch_reply_length = batch_reply_length + reply_length
+        if batch:
+            batches.append(batch)
+        return batches
+
     def update_derived_data_type_dictionary(self, display=False):
         # ToDo get the derived data types in such  a way they are easy to use
+        self._variable_type_objects = {}
         number_of_entries = self._get_number_of_derived_data_types()
         for index in range(1, number_of_entries + 1):
             reply = self._get_variable_type_object(index)
@@ -293,17 +464,23 @@ class NSeries:
         :return:
         """
         update_data_type_dictionary(self.connected_cip_dispatcher.data_type_dictionary)
+        self._variable_type_objects = {}
         variable_list = self._get_variable_list()
+        responses = self._multi_get_attribute_all(
+            [variable_request_path_segment(variable) for variable in variable_list], _VARIABLE_OBJECT_REPLY_SIZE)
+        variables = self.connected_cip_dispatcher.variables
+        system_variables = self.connected_cip_dispatcher.system_variables
+        user_variables = self.connected_cip_dispatcher.user_variables
         instance_id = 1
-        for variable in variable_list:
+        for variable, response in zip(variable_list, responses):
             # Instantiate the classes into objects
-            variable_cip_datatype = self._get_instance_from_variable_name(variable)
+            variable_cip_datatype = self._get_instance_from_variable_name(variable, response)
             variable_cip_datatype.variable_name = str(variable)
-            self.connected_cip_dispatcher.variables.update({variable: variable_cip_datatype})
-            if variable[0:1] == '_':
-                self.connected_cip_dispatcher.system_variables.update({variable: variable_cip_datatype})
+            variables[variable] = variable_cip_datatype
+            if variable.startswith('_'):
+                system_variables[variable] = variable_cip_datatype
             else:
-                self.connected_cip_dispatcher.user_variables.update({variable: variable_cip_datatype})
+                user_variables[variable] = variable_cip_datatype
             instance_id = instance_id + 1
 
     def save_current_dictionary(self, file_name: str):
@@ -340,8 +517,7 @@ class NSeries:
         :param variable_type_object:
         :return:
         """
-        nesting_id = variable_type_object.nesting_variable_type_instance_id
-        nesting_id = int.from_bytes(nesting_id, 'little')
+        nesting_id = variable_type_object.nesting_variable_type_instance_id_int
         nested_variable_type_object = self._get_variable_type_object(nesting_id)
         cip_datatype_instance = CIPStructure()
         cip_datatype_instance.instance_id = nesting_id
@@ -352,8 +528,7 @@ class NSeries:
         else:
             cip_datatype_instance.variable_type_name = str(variable_type_object.variable_type_name, 'utf-8')
         cip_datatype_instance.size = variable_type_object.size_in_memory
-        nest_id = variable_type_object.nesting_variable_type_instance_id
-        member_instance_id = int.from_bytes(nest_id, 'little')
+        member_instance_id = variable_type_object.nesting_variable_type_instance_id_int
         while member_instance_id != 0:
             member_cip_datatype_instance = self._get_member_instance(member_instance_id)
             if type(member_cip_datatype_instance) == CIPStructure:
@@ -364,24 +539,24 @@ class NSeries:
             variable_type_object_reply = self._get_variable_type_object(member_instance_id)
             member_name = str(variable_type_object_reply.variable_type_name, 'utf-8')
             cip_datatype_instance.members[member_name] = member_cip_datatype_instance
-            variable_type_object_reply = self._get_variable_type_object(member_instance_id)
-            member_instance_id = \
-                int.from_bytes(variable_type_object_reply.next_instance_id, 'little')
+            member_instance_id = variable_type_object_reply.next_instance_id_int
         return cip_datatype_instance
 
-    def _array_instance_from_variable_name(self, variable_name: str) -> CIPArray:
+    def _array_instance_from_variable_name(self, variable_name: str, response: CIPReply = None) -> CIPArray:
         """
         This method builds an array from information obtained from get_attribute_all on the
         variable_request_path
         :param variable_name:
+        :param response: get_attribute_all reply for the variable when it has already been read
         :return:
         """
         cip_array_instance = CIPArray()
-        request_path = variable_request_path_segment(variable_name)
-        response = self.connected_cip_dispatcher.get_attribute_all_service(request_path)
+        if response is None:
+            request_path = variable_request_path_segment(variable_name)
+            response = self.connected_cip_dispatcher.get_attribute_all_service(request_path)
         # Not actually a VariableObjectReply, but the data aligns the same
-        array_attributes_all_reply = VariableObjectReply(response.bytes)
-        instance_id = int.from_bytes(array_attributes_all_reply.variable_type_instance_id, 'little')
+        array_attributes_all_reply = VariableObjectReply.from_reply(response).parse()
+        instance_id = array_attributes_all_reply.variable_type_instance_id_int
         cip_array_instance.instance_id = instance_id
         if array_attributes_all_reply.cip_data_type_of_array == CIPStructure.data_type_code():
             array_member_instance = self._get_member_instance(instance_id)
@@ -414,9 +589,7 @@ class NSeries:
         """
         cip_array_instance = CIPArray()
         # Not actually a VariableObjectReply, but the data aligns the same
-        instance_id = variable_type_object.nesting_variable_type_instance_id
-        if type(instance_id) is bytes:
-            instance_id = int.from_bytes(instance_id, 'little', signed=False)
+        instance_id = variable_type_object.nesting_variable_type_instance_id_int
         cip_array_instance.instance_id = instance_id
         if variable_type_object.cip_data_type_of_array == CIPStructure.data_type_code():
             array_member_instance = self._get_member_instance(instance_id)
@@ -445,31 +618,33 @@ class NSeries:
         cip_string.size = variable_object.size
         return cip_string
 
-    def _get_instance_from_variable_name(self, variable_name: str):
+    def _get_instance_from_variable_name(self, variable_name: str, response: CIPReply = None):
         """
         This method returns the correct type of CIP Datatype instance based on the associated datatype
         that is discovered by calling the get_attribute_all CIP Service on the variable's request path.
         :param variable_name:
+        :param response: get_attribute_all reply for the variable when it has already been read
         :return:
         """
-        request_path = variable_request_path_segment(variable_name)
-        response = self.connected_cip_dispatcher.get_attribute_all_service(request_path)
+        if response is None:
+            request_path = variable_request_path_segment(variable_name)
+            response = self.connected_cip_dispatcher.get_attribute_all_service(request_path)
         data_type_code = response.reply_data[4:5]
         if data_type_code == CIPStructure.data_type_code():
-            variable_type_object_instance_id = int.from_bytes(response.reply_data[8:12], 'little')
+            variable_type_object_instance_id = _U32.unpack_from(response.reply_data_view, 8)[0]
             variable_type_object = self._get_variable_type_object(variable_type_object_instance_id)
             cip_data_type_instance = self._structure_instance_from_variable_type_object(variable_type_object)
         elif data_type_code == CIPAbbreviatedStructure.data_type_code():
-            variable_type_object_instance_id = int.from_bytes(response.reply_data[8:12], 'little')
+            variable_type_object_instance_id = _U32.unpack_from(response.reply_data_view, 8)[0]
             variable_type_object = self._get_variable_type_object(variable_type_object_instance_id)
             cip_data_type_instance = self._structure_instance_from_variable_type_object(variable_type_object)
         elif data_type_code == CIPString.data_type_code():
-            variable_type_object_instance_id = int.from_bytes(response.reply_data[8:12], 'little')
+            variable_type_object_instance_id = _U32.unpack_from(response.reply_data_view, 8)[0]
             variable_type_object = self._get_variable_type_object(variable_type_object_instance_id)
             cip_data_type_instance = self._string_instance_from_variable_type_object(variable_type_object)
             cip_data_type_instance.size = int.from_bytes(response.reply_data[0:2], 'little')
         elif data_type_code == CIPArray.data_type_code():
-            cip_data_type_instance = self._array_instance_from_variable_name(variable_name)
+            cip_data_type_instance = self._array_instance_from_variable_name(variable_name, response)
         elif data_type_code != b'':
             cip_data_type_instance = self.connected_cip_dispatcher.data_type_dictionary.get(data_type_code)()
         else:
@@ -483,11 +658,11 @@ class NSeries:
                     super_instance = super_instance[token]
             cip_data_type_instance = super_instance
         cip_data_type_instance.variable_name = str(variable_name)
-        self.connected_cip_dispatcher.variables.update({variable_name: cip_data_type_instance})
-        if variable_name[0:1] == '_':
-            self.connected_cip_dispatcher.system_variables.update({variable_name: cip_data_type_instance})
+        self.connected_cip_dispatcher.variables[variable_name] = cip_data_type_instance
+        if variable_name.startswith('_'):
+            self.connected_cip_dispatcher.system_variables[variable_name] = cip_data_type_instance
         else:
-            self.connected_cip_dispatcher.user_variables.update({variable_name: cip_data_type_instance})
+            self.connected_cip_dispatcher.user_variables[variable_name] = cip_data_type_instance
         return cip_data_type_instance
 
     def _get_member_instance(self, member_instance_id: int) -> CIPDataType:
@@ -522,7 +697,7 @@ class NSeries:
                                           variable_object.number_of_elements,
                                           variable_object.start_array_elements)
         else:
-            member_instance_id = int.from_bytes(variable_object.variable_type_instance_id, 'little')
+            member_instance_id = variable_object.variable_type_instance_id_int
             member_instance = self._get_member_instance(member_instance_id)
             cip_array_instance = member_instance
         return cip_array_instance
@@ -602,26 +777,27 @@ class NSeries:
         :return:
         """
         max_read_size = self.MAXIMUM_LENGTH - 8
-        data = b''
-        while offset < cip_datatype_object.size:
-            if cip_datatype_object.size - offset > max_read_size:
-                read_size = max_read_size
-            else:
-                read_size = cip_datatype_object.size - offset
+        # Joined once at the end, concatenating each chunk would copy everything read so far every time
+        chunks = []
+        remaining_size = cip_datatype_object.size - offset
+        while remaining_size > 0:
+            read_size = max_read_size if remaining_size > max_read_size else remaining_size
             response = self._simple_data_segment_read(cip_datatype_object, offset, read_size)
             reply_bytes = response.reply_data
             cip_common_format = CIPCommonFormat()
             cip_common_format.from_bytes(reply_bytes)
             if isinstance(cip_datatype_object, CIPString):
-                # First two characters of the string seem to be how many characters were read
-                data = data + cip_common_format.data[2:]
+                # First two characters of the string seem to be how many characters were read. Every reply
+                # carries its own count, the same way every chunk written is prefixed with its length
+                chunks.append(cip_common_format.data[2:])
             elif isinstance(cip_datatype_object, CIPStructure):
                 cip_datatype_object.crc_code = cip_common_format.additional_info
-                data = data + cip_common_format.data
+                chunks.append(cip_common_format.data)
             else:
-                data = data + cip_common_format.data
-            offset = offset + max_read_size
-        cip_datatype_object.data = data
+                chunks.append(cip_common_format.data)
+            offset = offset + read_size
+            remaining_size = remaining_size - read_size
+        cip_datatype_object.data = b''.join(chunks)
         # cip_datatype_object.size = len(data) # Removed Why did it exist? If weird stuff breaks revisit
         cip_datatype_object.value()
         return cip_datatype_object
@@ -639,15 +815,16 @@ class NSeries:
         # if isinstance(cip_datatype_object, CIPArray):
         #     max_write_size = max_write_size // cip_datatype_object.array_data_type_size * \
         #                      cip_datatype_object.array_data_type_size
-        while offset < cip_datatype_object.size:
-            if cip_datatype_object.size - offset > max_write_size:
-                write_size = max_write_size
-            else:
-                write_size = cip_datatype_object.size - offset
-            response = self._simple_data_segment_write(
-                cip_datatype_object, offset, write_size,
-                cip_datatype_object.data[offset:offset + write_size])
-            offset = offset + max_write_size
+        # Chunks are views of the data, they are only copied once when the request is joined
+        remaining_size = cip_datatype_object.size - offset
+        with memoryview(cip_datatype_object.data) as data_view:
+            while remaining_size > 0:
+                write_size = max_write_size if remaining_size > max_write_size else remaining_size
+                response = self._simple_data_segment_write(
+                    cip_datatype_object, offset, write_size,
+                    data_view[offset:offset + write_size])
+                offset = offset + write_size
+                remaining_size = remaining_size - write_size
         return response
 
     def _simple_data_segment_read(self, cip_datatype_object: CIPDataType, offset, read_size):
@@ -658,7 +835,6 @@ class NSeries:
         :param read_size:
         :return:
         """
-        # ToDo consider the request path should reside with the variable (possibly converted to logical segment)
         request_path = variable_request_path_segment(cip_datatype_object.variable_name)
         simple_data_request_path = SimpleDataSegmentRequest(offset, read_size)
         request_path = request_path + simple_data_request_path.bytes()
@@ -679,24 +855,25 @@ class NSeries:
         request_path = request_path + simple_data_request_path.bytes()
         # ToDo how to prevent testing type code here. Function is doing too much
         response = None
-        if cip_datatype_object.data_type_code() == CIPString.data_type_code():
-            data = struct.pack("<H", len(data)) + data
-            request_data = CIPCommonFormat(cip_datatype_object.data_type_code(), data=data)
+        data_type_code = cip_datatype_object.data_type_code()
+        if data_type_code == _CIP_STRING_CODE:
+            data = _U16.pack(len(data)) + data
+            request_data = CIPCommonFormat(data_type_code, data=data)
             response = self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
-        elif cip_datatype_object.data_type_code() == CIPArray.data_type_code():
+        elif data_type_code == _CIP_ARRAY_CODE:
             # ToDo Test String array. Probably have to put the length
-            if cip_datatype_object.array_data_type == CIPStructure.data_type_code():
+            if cip_datatype_object.array_data_type == _CIP_STRUCTURE_CODE:
                 structure_variable_type_object = \
                     self._get_variable_type_object(cip_datatype_object.instance_id)
-                crc_code = structure_variable_type_object.crc_code.to_bytes(2, 'little')
-                request_data = CIPCommonFormat(CIPAbbreviatedStructure.data_type_code(), additional_info_length=2,
+                crc_code = _U16.pack(structure_variable_type_object.crc_code)
+                request_data = CIPCommonFormat(_CIP_ABBREVIATED_STRUCTURE_CODE, additional_info_length=2,
                                                additional_info=crc_code,
                                                data=data)
             else:
                 request_data = CIPCommonFormat(cip_datatype_object.array_data_type, data=data)
             response = self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
-        elif cip_datatype_object.data_type_code() == CIPStructure.data_type_code():
-            request_data = CIPCommonFormat(CIPAbbreviatedStructure.data_type_code(), additional_info_length=2,
+        elif data_type_code == _CIP_STRUCTURE_CODE:
+            request_data = CIPCommonFormat(_CIP_ABBREVIATED_STRUCTURE_CODE, additional_info_length=2,
                                            additional_info=cip_datatype_object.crc_code, data=data)
             response = self.connected_cip_dispatcher.write_tag_service(request_path, request_data)
         return response
@@ -708,29 +885,31 @@ class NSeries:
         :param instance_id:
         :return:
         """
-        request_path = address_request_path_segment(
-            class_id=b'\x6b', instance_id=instance_id.to_bytes(2, 'little'))
-        variable_object_reply = VariableObjectReply(
-            self.connected_cip_dispatcher.get_attribute_all_service(request_path).bytes)
+        request_path = _VARIABLE_OBJECT_PATH_PREFIX + _U16.pack(instance_id)
+        variable_object_reply = VariableObjectReply.from_reply(
+            self.connected_cip_dispatcher.get_attribute_all_service(request_path))
         return variable_object_reply
 
     def _get_variable_type_object(self, instance_id: int) -> VariableTypeObjectReply:
         """
         Omron specific CIP class that is used to describe variable types. This is where derived data types
-        will have their member definitions
+        will have their member definitions. Replies are kept until the variable or derived data type
+        dictionary is updated again or the connection is made again
         :param instance_id:
         :return:
         """
-        request_path = address_request_path_segment(
-            class_id=b'\x6c', instance_id=instance_id.to_bytes(2, 'little'))
-        variable_type_object_reply = VariableTypeObjectReply(
-            self.connected_cip_dispatcher.get_attribute_all_service(request_path).bytes)
+        variable_type_object_reply = self._variable_type_objects.get(instance_id)
+        if variable_type_object_reply is None:
+            request_path = _VARIABLE_TYPE_OBJECT_PATH_PREFIX + _U16.pack(instance_id)
+            variable_type_object_reply = VariableTypeObjectReply.from_reply(
+                self.connected_cip_dispatcher.get_attribute_all_service(request_path))
+            self._variable_type_objects[instance_id] = variable_type_object_reply
         return variable_type_object_reply
 
     def _get_number_of_derived_data_types(self) -> int:
-        request_path = eip.address_request_path_segment(class_id=b'\x6c', instance_id=int(0).to_bytes(2, 'little'))
+        request_path = _VARIABLE_TYPE_OBJECT_PATH_PREFIX + _U16.pack(0)
         reply = self.connected_cip_dispatcher.get_attribute_all_service(request_path)
-        max_instance = struct.unpack("<H", reply.reply_data[2:4])[0]
+        max_instance = _U16.unpack_from(reply.reply_data_view, 2)[0]
         return max_instance
 
     def _get_variable_list(self):
@@ -739,11 +918,14 @@ class NSeries:
         :return:
         """
         tag_list = []
-        for tag_index in range(self._get_number_of_variables()):
-            offset = tag_index + 1
-            request_path = address_request_path_segment(b'\x6a', offset.to_bytes(2, 'little'))
-            reply = self.connected_cip_dispatcher.get_attribute_all_service(request_path)
-            tag = str(reply.reply_data[5:5 + int.from_bytes(reply.reply_data[4:5], 'little')], 'utf-8')
+        request_paths = [_TAG_NAME_SERVER_PATH_PREFIX + _U16.pack(offset)
+                         for offset in range(1, self._get_number_of_variables() + 1)]
+        for reply in self._multi_get_attribute_all(request_paths, _TAG_NAME_SERVER_REPLY_SIZE):
+            # Name length byte followed by the name, an instance the controller could not answer has no name
+            reply_data = reply.reply_data
+            if reply.general_status != 0 or len(reply_data) < 5:
+                continue
+            tag = reply_data[5:5 + reply_data[4]].decode('utf-8')
             tag_list.append(tag)
         return tag_list
 
@@ -752,7 +934,7 @@ class NSeries:
         Omron specific method to find number of variables from Tag Name Server
         :return:
         """
-        request_path = address_request_path_segment(b'\x6a', b'\x00\x00')
+        request_path = _TAG_NAME_SERVER_PATH_PREFIX + _U16.pack(0)
         reply = self.connected_cip_dispatcher.get_attribute_all_service(request_path)
         return int.from_bytes(reply.reply_data[2:4], 'little')
 
@@ -865,6 +1047,21 @@ class NSeriesThreadDispatcher:
             self.connect_explicit(host, connection_timeout, retry_time, max_attempts)
             self.register_session(retry_time)
 
+    @property
+    def message_timeout(self):
+        """
+        Seconds to wait for a reply from the controller before the command fails and the connection is remade
+        :return:
+        """
+        return self._instance.connected_cip_dispatcher.message_timeout
+
+    @message_timeout.setter
+    def message_timeout(self, message_timeout: float):
+        connected_cip_dispatcher = self._instance.connected_cip_dispatcher
+        connected_cip_dispatcher.message_timeout = message_timeout
+        if connected_cip_dispatcher.is_connected_explicit:
+            connected_cip_dispatcher.explicit_message_socket.settimeout(message_timeout)
+
     def add_monitored_variable(self, monitored_variable: MonitoredVariable):
         self.monitored_variable_dictionary[monitored_variable.variable_name] = monitored_variable
 
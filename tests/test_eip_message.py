@@ -0,0 +1,316 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+from aphyt.eip import *
+import struct
+import threading
+import unittest
+from unittest.mock import Mock
+
+
+class TestEIPMessage(unittest.TestCase):
+    def test_eip_message_bytes(self):
+        eip_message = EIPMessage(b'\x6f\x00', b'\x01\x02\x03', b'\x11\x22\x33\x44')
+        self.assertEqual(eip_message.bytes(),
+                         b'\x6f\x00\x03\x00\x11\x22\x33\x44' + b'\x00' * 16 + b'\x01\x02\x03')
+
+    def test_eip_message_length_follows_command_data(self):
+        eip_message = EIPMessage(b'\x65\x00')
+        eip_message.command_data = b'\x01\x00\x00\x00'
+        self.assertEqual(eip_message.bytes()[2:4], b'\x04\x00')
+
+    def test_eip_message_from_bytes(self):
+        eip_message = EIPMessage()
+        eip_message.from_bytes(b'\x65\x00\x04\x00\x11\x22\x33\x44' + b'\x00' * 16 + b'\x01\x00\x00\x00')
+        self.assertEqual(eip_message.command, b'\x65\x00')
+        self.assertEqual(eip_message.session_handle_id, b'\x11\x22\x33\x44')
+        self.assertEqual(eip_message.command_data, b'\x01\x00\x00\x00')
+
+    def test_list_identity_returns_bytes(self):
+        eip_test = EIPConnectedCIPDispatcher()
+        eip_test.is_connected_explicit = True
+        eip_test.explicit_message_socket, peer_socket = socket.socketpair()
+        peer_socket.sendall(b'\x63\x00\x02\x00' + b'\x00' * 20 + b'\x01\x00')
+        command_data = eip_test.list_identity()
+        eip_test.close_explicit()
+        peer_socket.close()
+        self.assertIsInstance(command_data, bytes)
+        self.assertEqual(command_data, b'\x01\x00')
+
+    def test_eip_message_from_bytes_ignores_trailing_data(self):
+        eip_message = EIPMessage()
+        eip_message.from_bytes(b'\x65\x00\x02\x00' + b'\x00' * 20 + b'\x01\x00\xff\xff')
+        self.assertEqual(eip_message.command_data, b'\x01\x00')
+        self.assertFalse(hasattr(eip_message, 'length'))
+
+    def test_data_and_address_item_bytes(self):
+        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, b'\x4c\x02')
+        self.assertEqual(data_address_item.bytes(), b'\xb2\x00\x02\x00\x4c\x02')
+
+    def test_command_specific_data_bytes(self):
+        command_specific_data = CommandSpecificData(encapsulated_packet=b'\x02\x00')
+        self.assertEqual(command_specific_data.bytes(), b'\x00\x00\x00\x00\x08\x00\x02\x00')
+
+    def test_common_packet_format_bytes(self):
+        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, b'\x4c\x02')
+        common_packet_format = CommonPacketFormat([data_address_item])
+        self.assertEqual(common_packet_format.bytes(), b'\x02\x00\x00\x00\x00\x00\xb2\x00\x02\x00\x4c\x02')
+
+    def test_common_packet_format_from_bytes(self):
+        common_packet_format = CommonPacketFormat([])
+        common_packet_format.from_bytes(b'\x03\x00\x00\x00\x00\x00\xb2\x00\x02\x00\xcc\x00\x02\x80\x01\x00\x07')
+        self.assertEqual(common_packet_format.item_count, 3)
+        self.assertEqual(len(common_packet_format.packets), 3)
+        self.assertEqual(common_packet_format.packets[1].type_id, DataAndAddressItem.UNCONNECTED_MESSAGE)
+        self.assertEqual(common_packet_format.packets[1].data, b'\xcc\x00')
+        self.assertEqual(common_packet_format.packets[2].type_id, DataAndAddressItem.SEQUENCED_ADDRESS_ITEM)
+        self.assertEqual(common_packet_format.packets[2].data, b'\x07')
+
+    def test_common_packet_format_from_short_bytes(self):
+        for packet_bytes in (b'', b'\x01\x00\xb2\x00'):
+            common_packet_format = CommonPacketFormat([])
+            common_packet_format.from_bytes(packet_bytes)
+            self.assertEqual(len(common_packet_format.packets), 2)
+            self.assertEqual(common_packet_format.packets[1].data, b'')
+
+    def test_common_packet_format_encode_unconnected(self):
+        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, b'\x4c\x02\x91\x01')
+        self.assertEqual(CommonPacketFormat.encode_unconnected(b'\x4c\x02\x91\x01'),
+                         CommonPacketFormat([data_address_item]).bytes())
+
+    def test_cip_request_bytes(self):
+        cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x03abc\x00', b'\x01\x00')
+        self.assertEqual(cip_request.bytes, b'\x4c\x03\x91\x03abc\x00\x01\x00')
+
+    def test_cip_request_int_service(self):
+        cip_request = CIPRequest(0x4c, b'\x91\x03abc\x00', b'\x01\x00')
+        self.assertEqual(cip_request.request_service, 0x4c)
+        self.assertEqual(cip_request.bytes, CIPRequest(b'\x4c', b'\x91\x03abc\x00', b'\x01\x00').bytes)
+
+    def test_cip_reply_bytes(self):
+        reply_bytes = b'\xcc\x00\x00\x00\xc4\x00\x01\x00\x00\x00'
+        self.assertEqual(CIPReply(reply_bytes).bytes, reply_bytes)
+
+    def test_cip_reply_copies_writable_buffer(self):
+        reply_buffer = bytearray(b'\xcc\x00\x00\x00\xc4\x00')
+        cip_reply = CIPReply(reply_buffer)
+        reply_buffer[4:6] = b'\x00\x00'
+        self.assertEqual(cip_reply.reply_data, b'\xc4\x00')
+        self.assertEqual(cip_reply.reply_data_view, b'\xc4\x00')
+
+    def test_cip_reply_from_reply_shares_buffer(self):
+        cip_reply = CIPReply(b'\x8a\x00\x00\x00\x01\x00\x04\x00\xcc\x00\x00\x00')
+        multiple_service_packet_reply = MultipleServicePacketReply.from_reply(cip_reply)
+        self.assertIsInstance(multiple_service_packet_reply, MultipleServicePacketReply)
+        self.assertIs(multiple_service_packet_reply.reply_view.obj, cip_reply.reply_view.obj)
+        self.assertEqual(multiple_service_packet_reply.replies[0].reply_service, 0xcc)
+
+    def test_cip_reply_short(self):
+        for reply_bytes in (b'', b'\xcc\x00'):
+            cip_reply = CIPReply(reply_bytes)
+            self.assertEqual(cip_reply.reply_service, 0)
+            self.assertEqual(cip_reply.general_status, 0)
+            self.assertEqual(cip_reply.extended_status, b'')
+            self.assertEqual(cip_reply.reply_data, b'')
+            self.assertEqual(cip_reply.bytes, reply_bytes)
+
+    def test_cip_reply_extended_status(self):
+        cip_reply = CIPReply(b'\xcc\x00\x01\x01\x05\x00\xc4\x00')
+        self.assertEqual(cip_reply.general_status, 0x01)
+        self.assertEqual(cip_reply.extended_status, b'\x05\x00')
+        self.assertEqual(cip_reply.reply_data, b'\xc4\x00')
+
+    def test_multiple_service_packet_reply(self):
+        reply = MultipleServicePacketReply(b'\x8a\x00\x00\x00\x02\x00\x06\x00\x0c\x00' +
+                                           b'\x81\x00\x00\x00\x01\x02' + b'\x81\x00\x08\x00')
+        replies = reply.replies
+        self.assertEqual(len(replies), 2)
+        self.assertEqual(replies[0].reply_data, b'\x01\x02')
+        self.assertEqual(replies[1].general_status, 0x08)
+        self.assertEqual(MultipleServicePacketReply(b'\x8a\x00\x08\x00').replies, [])
+
+
+class TestEIPConnectedCIPDispatcher(unittest.TestCase):
+    @staticmethod
+    def read_tag_reply() -> EIPMessage:
+        reply_message = EIPMessage()
+        reply_message.from_bytes(b'\x6f\x00\x16\x00' + b'\x00' * 20 +
+                                 b'\x00\x00\x00\x00\x08\x00\x02\x00\x00\x00\x00\x00\xb2\x00\x06\x00' +
+                                 b'\xcc\x00\x00\x00\xc3\x00')
+        return reply_message
+
+    def test_command_specific_data_from_eip_message(self):
+        eip_message = EIPMessage(b'\x6f\x00', b'\x00\x00\x00\x00\x0a\x00\x02\x00')
+        command_specific_data = EIPConnectedCIPDispatcher.command_specific_data_from_eip_message(eip_message)
+        self.assertEqual(command_specific_data.interface_handle, b'\x00\x00\x00\x00')
+        self.assertEqual(command_specific_data.timeout, b'\x0a\x00')
+        self.assertEqual(command_specific_data.encapsulated_packet, b'\x02\x00')
+
+    def test_execute_cip_command(self):
+        eip_test = EIPConnectedCIPDispatcher()
+        eip_test.send_command = Mock(return_value=self.read_tag_reply())
+        cip_reply = eip_test.execute_cip_command(CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00'))
+        self.assertEqual(cip_reply.reply_service, 0xcc)
+        self.assertEqual(cip_reply.reply_data, b'\xc3\x00')
+
+    def test_execute_cip_command_error_reply(self):
+        eip_test = EIPConnectedCIPDispatcher()
+        reply_message = EIPMessage(b'\x6f\x00', status=b'\x64\x00\x00\x00')
+        eip_test.send_command = Mock(return_value=reply_message)
+        cip_reply = eip_test.execute_cip_command(CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00'))
+        self.assertEqual(cip_reply.reply_data, b'')
+
+    def test_execute_cip_command_request(self):
+        eip_test = EIPConnectedCIPDispatcher()
+        eip_test.session_handle_id = b'\x11\x22\x33\x44'
+        eip_test.send_command = Mock(return_value=self.read_tag_reply())
+        cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00', b'\x01\x00')
+        eip_test.execute_cip_command(cip_request)
+        data_address_item = DataAndAddressItem(DataAndAddressItem.UNCONNECTED_MESSAGE, cip_request.bytes)
+        common_packet_format = CommonPacketFormat([data_address_item])
+        command_specific_data = CommandSpecificData(encapsulated_packet=common_packet_format.bytes())
+        eip_message = EIPMessage(b'\x6f\x00', command_specific_data.bytes(), b'\x11\x22\x33\x44')
+        self.assertEqual(eip_test.send_command.call_args.args[0].bytes(), eip_message.bytes())
+
+    def test_multiple_service_packet_service(self):
+        eip_test = EIPConnectedCIPDispatcher()
+        eip_test.execute_cip_command = Mock(return_value=CIPReply(b'\x8a\x00\x00\x00\x00\x00'))
+        eip_test.multiple_service_packet_service([CIPRequest(CIPService.GET_ATTRIBUTE_ALL, b'\x20\x6a\x24\x01'),
+                                                  CIPRequest(CIPService.GET_ATTRIBUTE_ALL, b'\x20\x6a\x24\x02')])
+        self.assertEqual(eip_test.execute_cip_command.call_args.args[0].bytes,
+                         b'\x0a\x02\x20\x02\x24\x01\x02\x00\x06\x00\x0c\x00' +
+                         b'\x01\x02\x20\x6a\x24\x01' + b'\x01\x02\x20\x6a\x24\x02')
+
+
+class TestEIPConnectedCommandMixin(unittest.TestCase):
+    def setUp(self):
+        self.eip_test = EIPConnectedCIPDispatcher()
+        self.eip_test.explicit_message_socket, self.peer_socket = socket.socketpair()
+        self.eip_test.is_connected_explicit = True
+
+    def tearDown(self):
+        self.eip_test.close_explicit()
+        self.peer_socket.close()
+
+    def test_send_command_reads_full_reply(self):
+        reply_bytes = b'\x65\x00\x04\x00\x11\x22\x33\x44' + b'\x00' * 16 + b'\x01\x00\x00\x00'
+        self.peer_socket.sendall(reply_bytes[:10])
+        threading.Timer(0.05, self.peer_socket.sendall, [reply_bytes[10:]]).start()
+        reply = self.eip_test.send_command(EIPMessage(b'\x65\x00', b'\x01\x00\x00\x00'), None)
+        self.assertEqual(reply.session_handle_id, b'\x11\x22\x33\x44')
+        self.assertEqual(reply.command_data, b'\x01\x00\x00\x00')
+        self.assertEqual(self.peer_socket.recv(4096), EIPMessage(b'\x65\x00', b'\x01\x00\x00\x00').bytes())
+
+    def test_receive_message_keeps_read_ahead(self):
+        first_reply = b'\x65\x00\x04\x00\x11\x22\x33\x44' + b'\x00' * 16 + b'\x01\x00\x00\x00'
+        second_reply = TestEIPConnectedCIPDispatcher.read_tag_reply().bytes()
+        self.peer_socket.sendall(first_reply + second_reply[:30])
+        self.assertEqual(self.eip_test._receive_message().bytes(), first_reply)
+        self.peer_socket.sendall(second_reply[30:])
+        self.assertEqual(self.eip_test._receive_message().bytes(), second_reply)
+        self.assertEqual(self.eip_test._receive_end, 0)
+
+    def test_receive_message_moves_partial_message(self):
+        reply = TestEIPConnectedCIPDispatcher.read_tag_reply().bytes()
+        self.eip_test._receive_start = self.eip_test._receive_end = self.eip_test.BUFFER_SIZE - 10
+        self.peer_socket.sendall(reply)
+        self.assertEqual(self.eip_test._receive_message().bytes(), reply)
+
+    def test_send_command_short_send(self):
+        eip_command = EIPMessage(b'\x6f\x00', b'\x01\x02\x03\x04')
+        self.eip_test.explicit_message_socket.close()
+        self.eip_test.explicit_message_socket = Mock()
+        self.eip_test.explicit_message_socket.sendmsg.return_value = 10
+        self.eip_test._send_message(eip_command)
+        self.eip_test.explicit_message_socket.sendall.assert_called_once_with(eip_command.bytes()[10:])
+
+    def test_send_rr_data_uses_session_header(self):
+        self.peer_socket.sendall(b'\x65\x00\x04\x00\x11\x22\x33\x44' + b'\x00' * 16 + b'\x01\x00\x00\x00')
+        self.eip_test.register_session()
+        self.peer_socket.recv(4096)
+        self.peer_socket.sendall(TestEIPConnectedCIPDispatcher.read_tag_reply().bytes())
+        cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00', b'\x01\x00')
+        cip_reply = self.eip_test.execute_cip_command(cip_request)
+        self.assertEqual(cip_reply.reply_data, b'\xc3\x00')
+        command_specific_data = CommandSpecificData(
+            encapsulated_packet=CommonPacketFormat.encode_unconnected(cip_request.bytes))
+        eip_message = EIPMessage(b'\x6f\x00', command_specific_data.bytes(), b'\x11\x22\x33\x44')
+        self.assertEqual(self.peer_socket.recv(4096), eip_message.bytes())
+
+    @staticmethod
+    def pipelined_reply(sequence_number: int, data_type: bytes) -> bytes:
+        reply = TestEIPConnectedCIPDispatcher.read_tag_reply()
+        reply.command_data = reply.command_data[:-2] + data_type + b'\x00'
+        reply.sender_context_data = struct.pack('<Q', sequence_number)
+        return reply.bytes()
+
+    def test_execute_cip_commands_pipelined(self):
+        self.eip_test.PIPELINE_WINDOW = 2
+        for sequence_number, data_type in ((1, b'\xc3'), (2, b'\xc4'), (3, b'\xc2')):
+            self.peer_socket.sendall(self.pipelined_reply(sequence_number, data_type))
+        cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00', b'\x01\x00')
+        cip_replies = self.eip_test.execute_cip_commands([cip_request] * 3)
+        self.assertEqual([cip_reply.reply_data for cip_reply in cip_replies],
+                         [b'\xc3\x00', b'\xc4\x00', b'\xc2\x00'])
+        sent_bytes = self.peer_socket.recv(4096)
+        command_specific_data = CommandSpecificData(
+            encapsulated_packet=CommonPacketFormat.encode_unconnected(cip_request.bytes))
+        self.assertEqual(len(sent_bytes), 3 * len(EIPMessage(b'\x6f\x00', command_specific_data.bytes()).bytes()))
+        self.assertEqual(sent_bytes[12:20], struct.pack('<Q', 1))
+
+    def test_execute_cip_commands_encapsulation_error(self):
+        error_reply = EIPMessage(b'\x6f\x00', status=b'\x64\x00\x00\x00', sender_context_data=struct.pack('<Q', 2))
+        self.peer_socket.sendall(self.pipelined_reply(1, b'\xc3') + error_reply.bytes() +
+                                 self.pipelined_reply(3, b'\xc2') + self.pipelined_reply(0, b'\x99'))
+        cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00', b'\x01\x00')
+        cip_replies = self.eip_test.execute_cip_commands([cip_request] * 3)
+        self.assertEqual([cip_reply.reply_data for cip_reply in cip_replies], [b'\xc3\x00', b'', b'\xc2\x00'])
+        self.assertEqual(self.eip_test.execute_cip_command(cip_request).reply_data, b'\x99\x00')
+
+    def test_execute_cip_commands_sender_context_mismatch(self):
+        self.eip_test.PIPELINE_WINDOW = 2
+        # The target does not echo the sender context
+        for data_type in (b'\xc3', b'\xc4', b'\xc2'):
+            self.peer_socket.sendall(self.pipelined_reply(0, data_type))
+        cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00', b'\x01\x00')
+        with self.assertRaises(ConnectionError):
+            self.eip_test.execute_cip_commands([cip_request] * 3)
+        self.assertFalse(self.eip_test.is_connected_explicit)
+        self.assertEqual(self.eip_test.explicit_message_socket.fileno(), -1)
+
+    def test_execute_cip_commands_closes_on_error(self):
+        self.peer_socket.sendall(self.pipelined_reply(1, b'\xc3'))
+        self.peer_socket.shutdown(socket.SHUT_WR)
+        cip_request = CIPRequest(CIPService.READ_TAG_SERVICE, b'\x91\x01a\x00', b'\x01\x00')
+        with self.assertRaises(ConnectionError):
+            self.eip_test.execute_cip_commands([cip_request] * 3)
+        self.assertFalse(self.eip_test.is_connected_explicit)
+
+    def test_context_manager_closes_connection(self):
+        with self.eip_test as eip_test:
+            self.assertTrue(eip_test.is_connected_explicit)
+        self.assertFalse(self.eip_test.is_connected_explicit)
+        self.assertEqual(self.eip_test.explicit_message_socket.fileno(), -1)
+
+    def test_send_command_closed_connection(self):
+        self.peer_socket.close()
+        with self.assertRaises(ConnectionError):
+            self.eip_test.send_command(EIPMessage(b'\x65\x00'), None)
+
+
+class TestRequestPath(unittest.TestCase):
+    def test_variable_request_path_segment(self):
+        self.assertEqual(variable_request_path_segment('TestInt'), b'\x91\x07TestInt\x00')
+
+    def test_variable_request_path_segment_element(self):
+        self.assertEqual(variable_request_path_segment('Arr[2].ab'),
+                         b'\x91\x03Arr\x00\x2a\x00\x02\x00\x00\x00\x91\x02ab')
+
+    def test_variable_request_path_segment_is_cached(self):
+        self.assertIs(variable_request_path_segment('TestCached'), variable_request_path_segment('TestCached'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+__author__ = 'Joseph Ryan'
+__license__ = "GPLv2"
+__maintainer__ = "Joseph Ryan"
+__email__ = "jr@aphyt.com"
+
+import socket
+import struct
+import unittest
+from unittest.mock import Mock
+from aphyt import cip, omron
+
+REPLY_HEADER = b'\x81\x00\x00\x00'
+
+
+def variable_type_object_reply_bytes(name: bytes, dimensions=(), start_array_elements=()) -> bytes:
+    reply_data = struct.pack("<LB1s1sB", 24, 0, b'\xa0', b'\xc4', len(dimensions))
+    reply_data += b''.join(struct.pack("<L", dimension) for dimension in dimensions)
+    reply_data += struct.pack("<H4sHB", 3, b'\x00' * 4, 0xbeef, len(name)) + name
+    if len(name) % 2 == 0:
+        reply_data += b'\x00'
+    reply_data += struct.pack("<LL", 0x0102, 0x0304)
+    reply_data += b''.join(struct.pack("<L", start) for start in start_array_elements)
+    return REPLY_HEADER + reply_data
+
+
+def variable_object_reply_bytes(dimensions=(), start_array_elements=()) -> bytes:
+    reply_data = struct.pack("<L1s1sBB", 40, b'\xa3', b'\xc3', len(dimensions), 0)
+    reply_data += b''.join(struct.pack("<L", dimension) for dimension in dimensions)
+    reply_data += struct.pack("<8sB3sL", b'\x00' * 8, 5, b'\x00' * 3, 0x0607)
+    reply_data += b''.join(struct.pack("<L", start) for start in start_array_elements)
+    return REPLY_HEADER + reply_data
+
+
+class TestVariableTypeObjectReply(unittest.TestCase):
+    def test_structure(self):
+        reply = omron.VariableTypeObjectReply(variable_type_object_reply_bytes(b'Member'))
+        self.assertEqual(reply.size_in_memory, 24)
+        self.assertEqual(reply.cip_data_type, b'\xa0')
+        self.assertEqual(reply.cip_data_type_of_array, b'\xc4')
+        self.assertEqual(reply.array_dimension, 0)
+        self.assertEqual(reply.number_of_elements, [])
+        self.assertEqual(reply.number_of_members, 3)
+        self.assertEqual(reply.crc_code, 0xbeef)
+        self.assertEqual(reply.variable_type_name_length, 6)
+        self.assertEqual(reply.padding, 1)
+        self.assertEqual(reply.variable_type_name, b'Member')
+        self.assertEqual(reply.next_instance_id, b'\x02\x01\x00\x00')
+        self.assertEqual(reply.nesting_variable_type_instance_id, b'\x04\x03\x00\x00')
+        self.assertEqual(reply.next_instance_id_int, 0x0102)
+        self.assertEqual(reply.nesting_variable_type_instance_id_int, 0x0304)
+
+    def test_array(self):
+        reply = omron.VariableTypeObjectReply(variable_type_object_reply_bytes(b'Arr', (3, 4), (1, 1)))
+        self.assertEqual(reply.array_dimension, 2)
+        self.assertEqual(reply.number_of_elements, [3, 4])
+        self.assertEqual(reply.padding, 0)
+        self.assertEqual(reply.variable_type_name, b'Arr')
+        self.assertEqual(reply.next_instance_id, b'\x02\x01\x00\x00')
+        self.assertEqual(reply.start_array_elements, [1, 1])
+
+    def test_fields_are_parsed_once(self):
+        reply = omron.VariableTypeObjectReply(variable_type_object_reply_bytes(b'Member'))
+        self.assertIs(reply.variable_type_name, reply.variable_type_name)
+        self.assertIs(reply.number_of_elements, reply.number_of_elements)
+
+    def test_fields_do_not_copy_reply_data(self):
+        reply = omron.VariableTypeObjectReply(variable_type_object_reply_bytes(b'Member'))
+        self.assertIsInstance(reply.variable_type_name, bytes)
+        self.assertIsInstance(reply.next_instance_id, bytes)
+        self.assertIsNone(reply._reply_data)
+
+
+class TestGetVariableTypeObject(unittest.TestCase):
+    def test_replies_are_cached(self):
+        n_series = omron.NSeries()
+        n_series.connected_cip_dispatcher.execute_cip_command = \
+            Mock(return_value=cip.CIPReply(variable_type_object_reply_bytes(b'Member')))
+        reply = n_series._get_variable_type_object(7)
+        self.assertIs(n_series._get_variable_type_object(7), reply)
+        self.assertEqual(n_series.connected_cip_dispatcher.execute_cip_command.call_count, 1)
+        n_series._get_variable_type_object(8)
+        self.assertEqual(n_series.connected_cip_dispatcher.execute_cip_command.call_count, 2)
+
+
+class TestVariableObjectReply(unittest.TestCase):
+    def test_array(self):
+        reply = omron.VariableObjectReply(variable_object_reply_bytes((2, 5), (0, 0)))
+        self.assertEqual(reply.size, 40)
+        self.assertEqual(reply.cip_data_type, b'\xa3')
+        self.assertEqual(reply.cip_data_type_of_array, b'\xc3')
+        self.assertEqual(reply.array_dimension, 2)
+        self.assertEqual(reply.number_of_elements, [2, 5])
+        self.assertEqual(reply.bit_number, 5)
+        self.assertEqual(reply.variable_type_instance_id, b'\x07\x06\x00\x00')
+        self.assertEqual(reply.variable_type_instance_id_int, 0x0607)
+        self.assertEqual(reply.start_array_elements, [0, 0])
+
+    def test_parse(self):
+        for dimensions, start_array_elements in (((), ()), ((2, 5), (1, 1))):
+            reply_bytes = variable_object_reply_bytes(dimensions, start_array_elements)
+            parsed_reply = omron.VariableObjectReply(reply_bytes).parse()
+            reply = omron.VariableObjectReply(reply_bytes)
+            for field in ('size', 'cip_data_type', 'cip_data_type_of_array', 'array_dimension', 'number_of_elements',
+                          '_dimension_offset', 'bit_number', 'variable_type_instance_id_int',
+                          'start_array_elements'):
+                self.assertIn(omron.n_series._parsed_key(field), parsed_reply.__dict__, field)
+            for field in ('size', 'cip_data_type', 'cip_data_type_of_array', 'array_dimension', 'number_of_elements',
+                          'bit_number', 'variable_type_instance_id', 'variable_type_instance_id_int',
+                          'start_array_elements'):
+                self.assertEqual(getattr(parsed_reply, field), getattr(reply, field), field)
+
+    def test_set_parsed_rejects_unknown_field(self):
+        reply = omron.VariableObjectReply(variable_object_reply_bytes((), ()))
+        with self.assertRaises(AttributeError):
+            omron.n_series._set_parsed(reply, sizes=4)
+
+
+class TestSimpleDataSegmentRequest(unittest.TestCase):
+    def test_bytes(self):
+        self.assertEqual(omron.SimpleDataSegmentRequest(0x01020304, 494).bytes(),
+                         b'\x80\x03\x04\x03\x02\x01\xee\x01')
+
+
+class TestNSeriesThreadDispatcher(unittest.TestCase):
+    def test_message_timeout(self):
+        thread_dispatcher = omron.NSeriesThreadDispatcher()
+        connected_cip_dispatcher = thread_dispatcher._instance.connected_cip_dispatcher
+        self.assertEqual(connected_cip_dispatcher.message_timeout, 0.5)
+        connected_cip_dispatcher.explicit_message_socket, peer_socket = socket.socketpair()
+        connected_cip_dispatcher.is_connected_explicit = True
+        thread_dispatcher.message_timeout = 0.25
+        self.assertEqual(connected_cip_dispatcher.explicit_message_socket.gettimeout(), 0.25)
+        connected_cip_dispatcher.close_explicit()
+        peer_socket.close()
+
+
+class TestMultiGetAttributeAll(unittest.TestCase):
+    def setUp(self):
+        self.n_series = omron.NSeries()
+        self.dispatcher = self.n_series.connected_cip_dispatcher
+        self.dispatcher.execute_cip_command = Mock(side_effect=self.execute_cip_command)
+
+    @staticmethod
+    def execute_cip_command(request: cip.CIPRequest) -> cip.CIPReply:
+        if request.request_service == 0x0a:
+            # Answer every embedded request but the second with its instance id
+            number_of_services = struct.unpack_from("<H", request.request_data)[0]
+            request_offsets = struct.unpack_from("<%dH" % number_of_services, request.request_data, 2)
+            replies = [b'\x81\x00\x00\x00' + request.request_data[offset + 6:offset + 7]
+                       if index != 1 else b'\x81\x00\x08\x00'
+                       for index, offset in enumerate(request_offsets)]
+            offsets = []
+            offset = 2 + 2 * number_of_services
+            for reply in replies:
+                offsets.append(offset)
+                offset = offset + len(reply)
+            return cip.CIPReply(b'\x8a\x00\x1e\x00' +
+                                struct.pack("<%dH" % (number_of_services + 1), number_of_services, *offsets) +
+                                b''.join(replies))
+        return cip.CIPReply(b'\x81\x00\x00\x00' + request.request_path[4:5])
+
+    def test_batches(self):
+        request_paths = [cip.address_request_path_segment(b'\x6a', index.to_bytes(2, 'little'))
+                         for index in range(1, 21)]
+        replies = self.n_series._multi_get_attribute_all(request_paths, 1)
+        self.assertEqual([reply.reply_data for reply in replies], [bytes([index]) for index in range(1, 21)])
+        # Two batches, each retrying its failed request on its own
+        self.assertEqual(self.dispatcher.execute_cip_command.call_count, 4)
+
+    def test_batches_fit_expected_reply(self):
+        request_paths = [cip.address_request_path_segment(b'\x6a', index.to_bytes(2, 'little'))
+                         for index in range(1, 21)]
+        # Five replies of 80 bytes fit in a message with their offsets and headers, six do not
+        batches = self.n_series._multiple_service_batches(request_paths, 80)
+        self.assertEqual([len(batch) for batch in batches], [5, 5, 5, 5])
+        self.assertEqual(sum(batches, []), list(range(20)))
+
+    def test_reply_too_large_splits_batch(self):
+        execute_cip_command = self.execute_cip_command
+
+        def reply_too_large(request: cip.CIPRequest) -> cip.CIPReply:
+            if request.request_service == 0x0a and struct.unpack_from("<H", request.request_data)[0] > 4:
+                return cip.CIPReply(b'\x8a\x00\x11\x00')
+            return execute_cip_command(request)
+
+        self.dispatcher.execute_cip_command = Mock(side_effect=reply_too_large)
+        request_paths = [cip.address_request_path_segment(b'\x6a', index.to_bytes(2, 'little'))
+                         for index in range(1, 9)]
+        replies = self.n_series._multi_get_attribute_all(request_paths, 1)
+        self.assertEqual([reply.reply_data for reply in replies], [bytes([index]) for index in range(1, 9)])
+        # The batch of eight, its two halves, then the failed second request of each half
+        self.assertEqual(self.dispatcher.execute_cip_command.call_count, 5)
+
+    def test_get_variable_list(self):
+        self.n_series.MULTIPLE_SERVICE_BATCH_SIZE = 1
+        tag_names = {0: b'\x00\x00\x02\x00',
+                     1: b'\x00\x00\x00\x00\x05Value',
+                     2: b'\x00\x00\x00\x00\x04_Sys\x00'}
+        self.dispatcher.execute_cip_command = Mock(side_effect=lambda request: cip.CIPReply(
+            b'\x81\x00\x00\x00' + tag_names[request.request_path[4]]))
+        self.assertEqual(self.n_series._get_variable_list(), ['Value', '_Sys'])
+
+    def test_get_variable_list_skips_error_replies(self):
+        self.n_series.MULTIPLE_SERVICE_BATCH_SIZE = 1
+        tag_replies = {0: b'\x81\x00\x00\x00\x00\x00\x03\x00',
+                       1: b'\x81\x00\x00\x00\x00\x00\x00\x00\x05Value',
+                       2: b'\x81\x00\x05\x00',
+                       3: b'\x81\x00\x00\x00\x00\x00\x00\x00\x04_Sys\x00'}
+        self.dispatcher.execute_cip_command = Mock(side_effect=lambda request: cip.CIPReply(
+            tag_replies[request.request_path[4]]))
+        self.assertEqual(self.n_series._get_variable_list(), ['Value', '_Sys'])
+
+
+class TestMultiMessageVariableRead(unittest.TestCase):
+    def test_string_chunks(self):
+        n_series = omron.NSeries()
+        text = bytes(range(65, 91)) * 40
+        requested = []
+
+        def simple_data_segment_read(cip_datatype_object, offset, read_size):
+            requested.append((offset, read_size))
+            chunk = text[offset:offset + read_size]
+            return cip.CIPReply(b'\xcc\x00\x00\x00\xd0\x00' + struct.pack("<H", len(chunk)) + chunk)
+
+        n_series._simple_data_segment_read = simple_data_segment_read
+        cip_string = cip.CIPString()
+        cip_string.size = len(text)
+        n_series._multi_message_variable_read(cip_string)
+        self.assertEqual(requested, [(0, 494), (494, 494), (988, 52)])
+        self.assertEqual(cip_string.data, text)
+
+    def test_string_write_chunks(self):
+        n_series = omron.NSeries()
+        n_series.connected_cip_dispatcher.write_tag_service = Mock()
+        cip_string = cip.CIPString()
+        cip_string.size = 500
+        cip_string.variable_name = 'Text'
+        cip_string.from_value('abc' * 150)
+        n_series._multi_message_variable_write(cip_string, 'abc' * 150)
+        written = [call.args[1].data for call in n_series.connected_cip_dispatcher.write_tag_service.call_args_list]
+        self.assertEqual(written, [struct.pack("<H", 400) + cip_string.data[:400],
+                                   struct.pack("<H", 100) + cip_string.data[400:]])
+
+
+if __name__ == '__main__':
+    unittest.main()